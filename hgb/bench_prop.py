@@ -0,0 +1,99 @@
+import os
+import gc
+import time
+import argparse
+import threading
+import multiprocessing as mp
+import numpy as np
+
+from utils import *
+from train_search import parse_args
+
+
+def current_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class RSSSampler(threading.Thread):
+    '''
+    Peak RSS of this process while it runs, sampled every interval seconds
+    '''
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = current_rss()
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, current_rss())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak
+
+
+def run_backend(args, backend, queue):
+    if args.seed > 0:
+        set_random_seed(args.seed)
+    g, adjs, init_labels, num_classes, dl, train_nid, val_nid, test_nid, test_nid_full, identity_types, sparse_feats \
+        = load_dataset(args)
+    tgt_type = NODE_TYPES[args.dataset][0]
+    gc.collect()
+
+    base = current_rss()
+    sampler = RSSSampler()
+    sampler.start()
+    tic = time.perf_counter()
+    g = hg_propagate_feat_dgl(g, tgt_type, args.num_hops, args.num_hops + 1, backend=backend,
+                              sparse_feats=sparse_feats, fill_threshold=args.sparse_fill_threshold)
+    toc = time.perf_counter()
+    peak = sampler.stop()
+
+    feats = {k: v.double() for k, v in g.nodes[tgt_type].data.items()}
+    feats.update({k: v.to_dense().double() for k, v in sparse_feats.items()})
+    queue.put({'time': toc - tic, 'peak': peak - base,
+               'sums': {k: v.sum().item() for k, v in feats.items()},
+               'norms': {k: v.norm().item() for k, v in feats.items()}})
+
+
+def main(bench_args, args):
+    # every backend runs in a fresh process, so peak memory is not shared between them
+    ctx = mp.get_context('spawn')
+    results = {}
+    for backend in bench_args.backends:
+        runs = []
+        for _ in range(bench_args.repeat):
+            queue = ctx.Queue()
+            p = ctx.Process(target=run_backend, args=(args, backend, queue))
+            p.start()
+            runs.append(queue.get())
+            p.join()
+        results[backend] = runs
+        times = [r['time'] for r in runs]
+        peaks = [r['peak'] for r in runs]
+        print(f'{backend}: time {np.mean(times):.3f}s (min {np.min(times):.3f}s), '
+              f'peak rss increase {np.max(peaks) / 2**20:.1f} MB, {len(runs[0]["sums"])} keys')
+
+    ref = results[bench_args.backends[0]][0]
+    for backend in bench_args.backends[1:]:
+        out = results[backend][0]
+        assert out['sums'].keys() == ref['sums'].keys(), f'{backend} gives other keys'
+        diff = max(abs(out['sums'][k] - ref['sums'][k]) / max(ref['norms'][k], 1e-12) for k in ref['sums'])
+        print(f'{backend} vs {bench_args.backends[0]}: max relative difference of key sums {diff:.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and memory of the feature propagation backends on one graph, '
+                                                 'other arguments are the ones of train_search.py')
+    parser.add_argument("--backends", nargs='+', type=str, default=['dgl', 'csr'])
+    parser.add_argument("--repeat", type=int, default=3)
+    bench_args, rest = parser.parse_known_args()
+    args = parse_args(rest)
+    args.seed = args.seeds[0]
+    assert args.dataset != 'Freebase', 'Freebase propagates sparse adjs, not features'
+    main(bench_args, args)
@@ -1,4 +1,5 @@
 import os
+import re
 import numpy as np
 import scipy.sparse as sp
 from collections import Counter, defaultdict
@@ -18,14 +19,254 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
+label_pattern = re.compile(r'^(\d+)\t[^\t\n]*\t(\d+)\t([^\n]*)$', re.M)
+
+
+def read_chunks(file_path, chunk_size=1 << 24, binary=False):
+    """
+    Stream a text file as blocks of whole lines, each of about chunk_size characters (bytes if binary)
+    """
+    with open(file_path, 'rb' if binary else 'r', **({} if binary else {'encoding': 'utf-8'})) as f:
+        rest = b'' if binary else ''
+        while True:
+            block = f.read(chunk_size)
+            if not block:
+                break
+            block = rest + block
+            end = block.rfind(b'\n' if binary else '\n') + 1
+            rest = block[end:]
+            if end:
+                yield block[:end]
+        if rest:
+            yield rest
+
+
+def count_lines(chunk):
+    return chunk.count('\n') + (not chunk.endswith('\n'))
+
+
+def range_mask(n, begins, ends):
+    """
+    Boolean mask of length n selecting the union of the disjoint ranges [begins[i], ends[i])
+    """
+    mark = np.zeros(n + 1, dtype=np.int8)
+    mark[begins] += 1
+    mark[ends] -= 1
+    return np.cumsum(mark[:n], dtype=np.int8).view(bool)
+
+
+def parse_node_chunk(chunk):
+    """
+    Parse a bytes block of node.dat lines (id, name, type and an optional attribute column)
+    without building Python objects per line
+        return node ids, node types, attribute length of every line and all attribute values
+    """
+    if not chunk.endswith(b'\n'):
+        chunk += b'\n'
+    buf = np.frombuffer(chunk, dtype=np.uint8)
+    line_end = np.flatnonzero(buf == ord('\n'))
+    line_beg = np.r_[0, line_end[:-1] + 1]
+    tabs = np.flatnonzero(buf == ord('\t'))
+    num_tabs = np.bincount(np.searchsorted(line_end, tabs), minlength=len(line_end))
+    if np.any((num_tabs != 2) & (num_tabs != 3)):
+        raise Exception("Too few information to parse!")
+    first_tab = np.r_[0, np.cumsum(num_tabs)[:-1]]
+    # type column ends at the third tab when there is an attribute column
+    type_end = np.where(num_tabs == 3, tabs[np.minimum(first_tab + 2, len(tabs) - 1)], line_end)
+    # the delimiter after each field is kept, whitespace separates the numbers
+    node_ids = np.fromstring(buf[range_mask(len(buf), line_beg, tabs[first_tab] + 1)], dtype=np.int64, sep=' ')
+    node_types = np.fromstring(buf[range_mask(len(buf), tabs[first_tab + 1] + 1, type_end + 1)],
+                               dtype=np.int64, sep=' ')
+    if len(node_ids) != len(line_end) or len(node_types) != len(line_end):
+        raise Exception("Too few information to parse!")
+
+    # Nodes with empty attribute column don't have attribute
+    has_attr = (num_tabs == 3) & (line_end > type_end + 1)
+    attr_lens = np.zeros(len(line_end), dtype=np.int64)
+    if not has_attr.any():
+        return node_ids, node_types, attr_lens, np.zeros(0, dtype=np.float32)
+    # attribute columns of all lines, each still ending with its newline
+    attr = buf[range_mask(len(buf), type_end[has_attr] + 1, line_end[has_attr] + 1)]
+    attr_end = np.flatnonzero(attr == ord('\n'))
+    is_comma = attr == ord(',')
+    attr_beg = np.r_[0, attr_end[:-1] + 1]
+    num_commas = np.empty(len(attr_beg), dtype=np.int64)
+    # reduceat converts its whole input to int64, so count the commas a block of lines at a time
+    for i in range(0, len(attr_beg), 1 << 12):
+        beg = attr_beg[i:i + (1 << 12)]
+        num_commas[i:i + len(beg)] = np.add.reduceat(is_comma[beg[0]:attr_end[i + len(beg) - 1] + 1],
+                                                     beg - beg[0], dtype=np.int64)
+    attr_lens[has_attr] = num_commas + 1
+    attr[attr_end] = ord(',')
+    # a known count lets fromstring allocate the values once
+    attr_vals = np.fromstring(attr, dtype=np.float32, count=int(attr_lens.sum()), sep=',')
+    return node_ids, node_types, attr_lens, attr_vals
+
+
+def chain_product(mats):
+    """
+    Multiply a chain of sparse matrices in the order with the lowest estimated cost.
+    The cost of A.dot(B) is taken as nnz(A) * nnz(B) / inner dim, i.e. the expected number of
+    multiply-adds if nonzeros are spread uniformly, and also serves as the nnz estimate of the result
+    """
+    n = len(mats)
+    shape = [[None] * n for _ in range(n)]
+    nnz = [[0] * n for _ in range(n)]
+    cost = [[0] * n for _ in range(n)]
+    split = [[None] * n for _ in range(n)]
+    for i, mat in enumerate(mats):
+        shape[i][i] = mat.shape
+        nnz[i][i] = mat.nnz
+    for length in range(2, n + 1):
+        for i in range(n - length + 1):
+            j = i + length - 1
+            for k in range(i, j):
+                flops = nnz[i][k] * nnz[k+1][j] / max(shape[i][k][1], 1)
+                c = cost[i][k] + cost[k+1][j] + flops
+                if split[i][j] is None or c < cost[i][j]:
+                    cost[i][j] = c
+                    split[i][j] = k
+                    shape[i][j] = (shape[i][k][0], shape[k+1][j][1])
+                    nnz[i][j] = min(shape[i][j][0] * shape[i][j][1], flops)
+
+    def multiply(i, j):
+        if i == j:
+            return mats[i]
+        k = split[i][j]
+        return multiply(i, k).dot(multiply(k + 1, j)).tocsr()
+    return multiply(0, n - 1)
+
+
 class data_loader:
-    def __init__(self, path):
+    source_files = ['node.dat', 'link.dat', 'label.dat', 'label.dat.test']
+    # bump whenever the cached arrays change: 1 (unversioned keys) float64 attributes,
+    # 2 label arrays, 3 float32 attributes from the bulk parser
+    cache_version = 3
+
+    def __init__(self, path, use_cache=True, attr_types=None):
+        """
+        attr_types: node types whose attribute matrices are kept, None for all types.
+        The attributes of the other types are left as None (and not read at all from the cache)
+        """
         self.path = path
+        self.attr_types = attr_types
+        self.cache_file = os.path.join(path, 'dl_cache.npz')
+        self.cache_key = self.get_source_key()
+        if use_cache and self.load_cache():
+            return
         self.nodes = self.load_nodes()
         self.links = self.load_links()
         self.labels_train = self.load_labels('label.dat')
         self.labels_test = self.load_labels('label.dat.test')
-        self.labels_test_full = self.load_labels('label.dat.test')    #self.load_labels('label.dat.test_full')
+        self.labels_test_full = self.labels_test    #self.load_labels('label.dat.test_full')
+        if use_cache:
+            self.save_cache()
+        if attr_types is not None:
+            for i in self.nodes['attr']:
+                if i not in attr_types:
+                    self.nodes['attr'][i] = None
+
+    def get_source_key(self):
+        """
+        Key of the binary cache, built from the size and mtime of every source file
+        """
+        key = [f'v{self.cache_version}']
+        for name in self.source_files:
+            st = os.stat(os.path.join(self.path, name))
+            key.append(f'{name}:{st.st_size}:{st.st_mtime_ns}')
+        return ';'.join(key)
+
+    def save_cache(self):
+        """
+        Dump nodes, links and labels into a compact npz file next to the source files.
+        The file is written to a temporary name first, so an interrupted run never leaves a broken cache.
+        """
+        arrays = {'key': np.array(self.cache_key)}
+        num_types = len(self.nodes['count'])
+        arrays['node_count'] = np.array([self.nodes['count'][i] for i in range(num_types)], dtype=np.int64)
+        for i in range(num_types):
+            if self.nodes['attr'][i] is not None:
+                arrays[f'attr_{i}'] = self.nodes['attr'][i]
+
+        r_ids = list(self.links['data'].keys())
+        arrays['link_ids'] = np.array(r_ids, dtype=np.int64)
+        arrays['link_meta'] = np.array([self.links['meta'][r_id] for r_id in r_ids], dtype=np.int64).reshape(-1, 2)
+        arrays['link_count'] = np.array([self.links['count'][r_id] for r_id in r_ids], dtype=np.int64)
+        for r_id in r_ids:
+            mat = self.links['data'][r_id]
+            arrays[f'link_{r_id}_indptr'] = mat.indptr
+            arrays[f'link_{r_id}_indices'] = mat.indices
+            arrays[f'link_{r_id}_data'] = mat.data
+
+        for name, labels in [('train', self.labels_train), ('test', self.labels_test)]:
+            arrays[f'label_{name}_nodes'] = labels['nodes']
+            arrays[f'label_{name}_classes'] = labels['classes']
+            if labels['indptr'] is not None:
+                arrays[f'label_{name}_indptr'] = labels['indptr']
+            arrays[f'label_{name}_info'] = np.array([labels['num_classes'], labels['total']], dtype=np.int64)
+            arrays[f'label_{name}_count'] = np.array(list(labels['count'].items()), dtype=np.int64).reshape(-1, 2)
+
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            print(f'{bcolors.WARNING}Warning: cannot write data cache {self.cache_file}: {e}{bcolors.ENDC}')
+
+    def load_cache(self):
+        """
+        Restore nodes, links and labels from the npz cache without parsing any text.
+        return False if there is no cache or it was built from different source files
+        """
+        if not os.path.exists(self.cache_file):
+            return False
+        try:
+            cache = np.load(self.cache_file, allow_pickle=False)
+        except (OSError, ValueError):
+            return False
+        with cache:
+            if 'key' not in cache.files or str(cache['key']) != self.cache_key:
+                return False
+
+            node_count = cache['node_count']
+            nodes = {'total':0, 'count':Counter(), 'attr':{}, 'shift':{}}
+            shift = 0
+            for i, cnt in enumerate(node_count.tolist()):
+                nodes['count'][i] = cnt
+                nodes['shift'][i] = shift
+                keep_attr = self.attr_types is None or i in self.attr_types
+                nodes['attr'][i] = cache[f'attr_{i}'] if keep_attr and f'attr_{i}' in cache.files else None
+                shift += cnt
+            nodes['total'] = shift
+
+            links = {'total':0, 'count':Counter(), 'meta':{}, 'data':{}}
+            for r_id, (h_type, t_type), cnt in zip(cache['link_ids'].tolist(), cache['link_meta'].tolist(), cache['link_count'].tolist()):
+                mat = sp.csr_matrix((cache[f'link_{r_id}_data'], cache[f'link_{r_id}_indices'], cache[f'link_{r_id}_indptr']),
+                                    shape=(nodes['total'], nodes['total']))
+                links['meta'][r_id] = (h_type, t_type)
+                links['data'][r_id] = mat
+                links['count'][r_id] = cnt
+                links['total'] += cnt
+
+            all_labels = {}
+            for name in ['train', 'test']:
+                num_classes, total = cache[f'label_{name}_info'].tolist()
+                labels = {'num_classes':num_classes, 'total':total, 'count':Counter(), 'nodes':None, 'classes':None, 'indptr':None}
+                for node_type, cnt in cache[f'label_{name}_count'].tolist():
+                    labels['count'][node_type] = cnt
+                labels['nodes'] = cache[f'label_{name}_nodes']
+                labels['classes'] = cache[f'label_{name}_classes']
+                if f'label_{name}_indptr' in cache.files:
+                    labels['indptr'] = cache[f'label_{name}_indptr']
+                all_labels[name] = labels
+
+        self.nodes = nodes
+        self.links = links
+        self.labels_train = all_labels['train']
+        self.labels_test = all_labels['test']
+        self.labels_test_full = self.labels_test
+        return True
 
     def get_sub_graph(self, node_types_tokeep):
         """
@@ -33,16 +274,17 @@ class data_loader:
         We only support whole type sub-graph for now.
         This is an in-place update function!
         return: old node type id to new node type id dict, old edge type id to new edge type id dict
+        Every kept type is a contiguous id range, so labels and relations are copied by slices
         """
         keep = set(node_types_tokeep)
         new_node_type = 0
         new_node_id = 0
         new_nodes = {'total':0, 'count':Counter(), 'attr':{}, 'shift':{}}
         new_links = {'total':0, 'count':Counter(), 'meta':{}, 'data':defaultdict(list)}
-        new_labels_train = {'num_classes':0, 'total':0, 'count':Counter(), 'data':None, 'mask':None}
-        new_labels_test = {'num_classes':0, 'total':0, 'count':Counter(), 'data':None, 'mask':None}
+        new_labels_train = {'num_classes':0, 'total':0, 'count':Counter(), 'nodes':None, 'classes':None, 'indptr':None}
+        new_labels_test = {'num_classes':0, 'total':0, 'count':Counter(), 'nodes':None, 'classes':None, 'indptr':None}
         old_nt2new_nt = {}
-        old_idx = []
+        old_ranges = []
         for node_type in self.nodes['count']:
             if node_type in keep:
                 nt = node_type
@@ -54,7 +296,7 @@ class data_loader:
                 new_nodes['attr'][nnt] = self.nodes['attr'][nt]
                 new_nodes['shift'][nnt] = new_node_id
                 beg = self.nodes['shift'][nt]
-                old_idx.extend(range(beg, beg+cnt))
+                old_ranges.append((beg, cnt))
                 
                 cnt_label_train = self.labels_train['count'][nt]
                 new_labels_train['count'][nnt] = cnt_label_train
@@ -68,11 +310,12 @@ class data_loader:
 
         new_labels_train['num_classes'] = self.labels_train['num_classes']
         new_labels_test['num_classes'] = self.labels_test['num_classes']
-        for k in ['data', 'mask']:
-            new_labels_train[k] = self.labels_train[k][old_idx]
-            new_labels_test[k] = self.labels_test[k][old_idx]
+        new_shifts = [new_nodes['shift'][nnt] for nnt in old_nt2new_nt.values()]
+        self.slice_labels(self.labels_train, new_labels_train, old_ranges, new_shifts)
+        self.slice_labels(self.labels_test, new_labels_test, old_ranges, new_shifts)
 
         old_et2new_et = {}
+        new_blocks = {}
         new_edge_type = 0
         for edge_type in self.links['count']:
             h, t = self.links['meta'][edge_type]
@@ -83,100 +326,212 @@ class data_loader:
                 new_links['total'] += self.links['count'][et]
                 new_links['count'][net] = self.links['count'][et]
                 new_links['meta'][net] = tuple(map(lambda x:old_nt2new_nt[x], self.links['meta'][et]))
-                new_links['data'][net] = self.links['data'][et][old_idx][:, old_idx]
+                new_blocks[net] = self.get_edge_block(et)
                 new_edge_type += 1
 
         self.nodes = new_nodes
+        for net, block in new_blocks.items():
+            h, t = new_links['meta'][net]
+            new_links['data'][net] = self.block_to_global(block, h, t)
         self.links = new_links
         self.labels_train = new_labels_train
         self.labels_test = new_labels_test
         return old_nt2new_nt, old_et2new_et
 
-    def get_meta_path(self, meta=[]):
+    def slice_labels(self, labels, new_labels, old_ranges, new_shifts):
+        """
+        Copy the labels of the old id ranges (beg, cnt) into new_labels, moving each range to its new shift
+        """
+        node_parts, class_parts, len_parts = [], [], []
+        for (beg, cnt), new_beg in zip(old_ranges, new_shifts):
+            lo, hi = np.searchsorted(labels['nodes'], [beg, beg + cnt])
+            node_parts.append(labels['nodes'][lo:hi] - beg + new_beg)
+            if labels['indptr'] is None:
+                class_parts.append(labels['classes'][lo:hi])
+            else:
+                class_parts.append(labels['classes'][labels['indptr'][lo]:labels['indptr'][hi]])
+                len_parts.append(np.diff(labels['indptr'][lo:hi+1]))
+        new_labels['nodes'] = np.concatenate(node_parts)
+        new_labels['classes'] = np.concatenate(class_parts)
+        if labels['indptr'] is not None:
+            new_labels['indptr'] = np.concatenate(([0], np.cumsum(np.concatenate(len_parts)))).astype(np.int64)
+
+    def get_label_matrix(self, labels, node_ids):
+        """
+        Dense one-hot (multi-hot for multi-label data) rows of the given node ids,
+        a numpy matrix with shape (len(node_ids), labels['num_classes']), unlabeled nodes get all-zero rows
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        out = np.zeros((len(node_ids), labels['num_classes']), dtype=int)
+        if len(labels['nodes']) == 0:
+            return out
+        pos = np.minimum(np.searchsorted(labels['nodes'], node_ids), len(labels['nodes']) - 1)
+        rows = np.flatnonzero(labels['nodes'][pos] == node_ids)
+        pos = pos[rows]
+        if labels['indptr'] is None:
+            out[rows, labels['classes'][pos]] = 1
+        else:
+            lens = labels['indptr'][pos+1] - labels['indptr'][pos]
+            offset = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+            out[np.repeat(rows, lens), labels['classes'][np.repeat(labels['indptr'][pos], lens) + offset]] = 1
+        return out
+
+    def get_meta_path(self, meta=[], typed=False):
         """
         Get meta path matrix
             meta is a list of edge types (also can be denoted by a pair of node types)
-            return a sparse matrix with shape [node_num, node_num]
+            return a sparse matrix with shape [node_num, node_num],
+            or [count of start type, count of end type] if typed is True
+        Only the typed blocks of the involved relations are multiplied
         """
-        ini = sp.eye(self.nodes['total'])
+        if len(meta) == 0:
+            return sp.eye(self.nodes['total'])
         meta = [self.get_edge_type(x) for x in meta]
-        for x in meta:
-            ini = ini.dot(self.links['data'][x]) if x >= 0 else ini.dot(self.links['data'][-x - 1].T)
-        return ini
+        block = chain_product([self.get_edge_block(x) for x in meta]).astype(np.float64)
+        if typed:
+            return block
+        h = self.links['meta'][meta[0]][0] if meta[0]>=0 else self.links['meta'][-meta[0]-1][1]
+        t = self.links['meta'][meta[-1]][1] if meta[-1]>=0 else self.links['meta'][-meta[-1]-1][0]
+        return self.block_to_global(block, h, t)
 
-    def dfs(self, now, meta, meta_dict):
-        if len(meta) == 0:
-            meta_dict[now[0]].append(now)
-            return
-        th_mat = self.links['data'][meta[0]] if meta[0] >= 0 else self.links['data'][-meta[0] - 1].T
-        th_node = now[-1]
-        for col in th_mat[th_node].nonzero()[1]:
-            self.dfs(now+[col], meta[1:], meta_dict)
+    def get_edge_block(self, edge_type):
+        """
+        Typed block of an edge type returned by get_edge_type (negative means the reversed relation),
+        a CSR matrix with shape [count of head type, count of tail type] sliced out of the global one
+        """
+        mat = self.links['data'][edge_type if edge_type >= 0 else -edge_type - 1]
+        h, t = self.links['meta'][edge_type if edge_type >= 0 else -edge_type - 1]
+        beg = self.nodes['shift'][h]
+        indptr = mat.indptr[beg:beg+self.nodes['count'][h]+1]
+        block = sp.csr_matrix((mat.data[indptr[0]:indptr[-1]], mat.indices[indptr[0]:indptr[-1]] - self.nodes['shift'][t],
+                               indptr - indptr[0]), shape=(self.nodes['count'][h], self.nodes['count'][t]))
+        return block if edge_type >= 0 else block.T.tocsr()
+
+    def block_to_global(self, block, h, t):
+        """
+        Place a typed block of node types (h, t) into a [node_num, node_num] CSR matrix
+        """
+        total = self.nodes['total']
+        row_beg = self.nodes['shift'][h]
+        indptr = np.concatenate((np.zeros(row_beg, dtype=block.indptr.dtype), block.indptr,
+                                 np.full(total - row_beg - block.shape[0], block.nnz, dtype=block.indptr.dtype)))
+        return sp.csr_matrix((block.data, block.indices + self.nodes['shift'][t], indptr), shape=(total, total))
+
+    def get_edge_mat(self, edge_type):
+        """
+        CSR matrix of an edge type returned by get_edge_type, negative means the reversed relation
+        """
+        if edge_type >= 0:
+            return self.links['data'][edge_type]
+        return self.links['data'][-edge_type - 1].T.tocsr()
+
+    def iter_meta_path_instances(self, meta=[], chunk_size=1 << 20, max_per_node=None):
+        """
+        Enumerate meta path instances hop by hop with CSR gathers
+            meta is a list of edge types (also can be denoted by a pair of node types)
+            yield int64 arrays with shape [n, len(meta)+1] and n <= chunk_size (unless a single node
+            has more neighbors than chunk_size), one instance per row, grouped by start node in dfs order
+            max_per_node keeps only the first max_per_node instances of each start node, the cap is applied
+            at every hop before the gather so it also bounds the work and memory
+        """
+        meta = [self.get_edge_type(x) for x in meta]
+        mats = [(mat.indptr, mat.indices) for mat in map(self.get_edge_mat, meta)]
+        if max_per_node is not None:
+            # drop edges into nodes that can't finish the meta path, then every partial instance kept
+            # ends in at least one instance and the first max_per_node of them are enough
+            alive = np.ones(self.nodes['total'], dtype=bool)
+            for depth in reversed(range(len(mats))):
+                indptr, indices = mats[depth]
+                keep = alive[indices]
+                indptr = np.r_[0, np.cumsum(keep)][indptr]
+                mats[depth] = (indptr, indices[keep])
+                alive = np.diff(indptr) > 0
+        start_node_type = self.links['meta'][meta[0]][0] if meta[0]>=0 else self.links['meta'][-meta[0]-1][1]
+        beg = self.nodes['shift'][start_node_type]
+        start_nodes = np.arange(beg, beg+self.nodes['count'][start_node_type], dtype=np.int64)
+
+        # partial instances still to expand, the top of the stack always comes first in dfs order
+        stack = [start_nodes[i:i+chunk_size, None] for i in reversed(range(0, len(start_nodes), chunk_size))]
+        last_start, last_count = -1, 0
+        while len(stack):
+            paths = stack.pop()
+            depth = paths.shape[1] - 1
+            if depth < len(meta):
+                indptr, indices = mats[depth]
+                last = paths[:, -1]
+                deg = (indptr[last+1] - indptr[last]).astype(np.int64)
+                if max_per_node is not None:
+                    # rows each start node already has, from earlier partial instances and finished ones
+                    starts = paths[:, 0]
+                    new_group = np.r_[True, starts[1:] != starts[:-1]]
+                    before = np.cumsum(deg) - deg
+                    before -= before[new_group][np.cumsum(new_group) - 1]
+                    before[starts == last_start] += last_count
+                    deg = np.minimum(deg, np.maximum(max_per_node - before, 0))
+                cum_deg = np.cumsum(deg)
+                if len(paths) > 1 and cum_deg[-1] > chunk_size:
+                    split = max(1, np.searchsorted(cum_deg, chunk_size, side='right'))
+                    stack.append(paths[split:])
+                    stack.append(paths[:split])
+                    continue
+                # gather the neighbors of every last node, each partial instance repeated deg times
+                offset = np.arange(cum_deg[-1] if len(deg) else 0) - np.repeat(cum_deg - deg, deg)
+                nxt = indices[np.repeat(indptr[last].astype(np.int64), deg) + offset]
+                paths = np.concatenate((np.repeat(paths, deg, axis=0), nxt[:, None].astype(np.int64)), axis=1)
+                for i in reversed(range(0, len(paths), chunk_size)):
+                    stack.append(paths[i:i+chunk_size])
+                continue
+
+            if len(paths) == 0:
+                continue
+            if max_per_node is not None:
+                tail = np.count_nonzero(paths[:, 0] == paths[-1, 0])
+                last_count = tail + (last_count if paths[-1, 0] == last_start else 0)
+                last_start = paths[-1, 0]
+            yield paths
 
     def get_full_meta_path(self, meta=[], symmetric=False):
         """
         Get full meta path for each node
             meta is a list of edge types (also can be denoted by a pair of node types)
             return a dict of list[list] (key is node_id)
+            symmetric is kept for compatibility, instances are always enumerated directly
         """
-        meta = [self.get_edge_type(x) for x in meta]
-        if len(meta) == 1:
-            meta_dict = {}
-            start_node_type = self.links['meta'][meta[0]][0] if meta[0]>=0 else self.links['meta'][-meta[0]-1][1]
-            for i in range(self.nodes['shift'][start_node_type], self.nodes['shift'][start_node_type]+self.nodes['count'][start_node_type]):
-                meta_dict[i] = []
-                self.dfs([i], meta, meta_dict)
-        else:
-            meta_dict1 = {}
-            meta_dict2 = {}
-            mid = len(meta) // 2
-            meta1 = meta[:mid]
-            meta2 = meta[mid:]
-            start_node_type = self.links['meta'][meta1[0]][0] if meta1[0]>=0 else self.links['meta'][-meta1[0]-1][1]
-            for i in range(self.nodes['shift'][start_node_type], self.nodes['shift'][start_node_type]+self.nodes['count'][start_node_type]):
-                meta_dict1[i] = []
-                self.dfs([i], meta1, meta_dict1)
-            start_node_type = self.links['meta'][meta2[0]][0] if meta2[0]>=0 else self.links['meta'][-meta2[0]-1][1]
-            for i in range(self.nodes['shift'][start_node_type], self.nodes['shift'][start_node_type]+self.nodes['count'][start_node_type]):
-                meta_dict2[i] = []
-            if symmetric:
-                for k in meta_dict1:
-                    paths = meta_dict1[k]
-                    for x in paths:
-                        meta_dict2[x[-1]].append(list(reversed(x)))
-            else:
-                for i in range(self.nodes['shift'][start_node_type], self.nodes['shift'][start_node_type]+self.nodes['count'][start_node_type]):
-                    self.dfs([i], meta2, meta_dict2)
-            meta_dict = {}
-            start_node_type = self.links['meta'][meta1[0]][0] if meta1[0]>=0 else self.links['meta'][-meta1[0]-1][1]
-            for i in range(self.nodes['shift'][start_node_type], self.nodes['shift'][start_node_type]+self.nodes['count'][start_node_type]):
-                meta_dict[i] = []
-                for beg in meta_dict1[i]:
-                    for end in meta_dict2[beg[-1]]:
-                        meta_dict[i].append(beg + end[1:])
+        meta_ids = [self.get_edge_type(x) for x in meta]
+        start_node_type = self.links['meta'][meta_ids[0]][0] if meta_ids[0]>=0 else self.links['meta'][-meta_ids[0]-1][1]
+        beg = self.nodes['shift'][start_node_type]
+        meta_dict = {i: [] for i in range(beg, beg+self.nodes['count'][start_node_type])}
+        for paths in self.iter_meta_path_instances(meta):
+            for path in paths.tolist():
+                meta_dict[path[0]].append(path)
         return meta_dict
 
-    def gen_file_for_evaluate(self, test_idx, label, file_path, mode='bi'):
+    def gen_file_for_evaluate(self, test_idx, label, file_path, mode='bi', block_size=1 << 16):
         if test_idx.shape[0] != label.shape[0]:
             return
         if mode == 'multi':
-            multi_label=[]
-            for i in range(label.shape[0]):
-                label_list = [str(j) for j in range(label[i].shape[0]) if label[i][j]==1]
-                multi_label.append(','.join(label_list))
-            label=multi_label
+            # build the comma separated label lists column by column instead of row by row
+            label = np.asarray(label)
+            tokens = np.where(label == 1, np.char.add(np.arange(label.shape[1]).astype(str), ','), '')
+            multi_label = np.zeros(label.shape[0], dtype=str)
+            for j in range(label.shape[1]):
+                multi_label = np.char.add(multi_label, tokens[:, j])
+            label = np.char.rstrip(multi_label, ',')
         elif mode=='bi':
-            label = np.array(label)
+            label = np.array(label).astype(str)
         else:
             return
+        test_idx = np.asarray(test_idx)
+        lines = np.char.add(np.char.add(test_idx.astype(str), '\t\t'), self.get_node_type(test_idx).astype(str))
+        lines = np.char.add(np.char.add(lines, '\t'), label)
         with open(file_path, "w") as f:
-            for nid, l in zip(test_idx, label):
-                f.write(f"{nid}\t\t{self.get_node_type(nid)}\t{l}\n")
+            for beg in range(0, len(lines), block_size):
+                f.write('\n'.join(lines[beg:beg+block_size]) + '\n')
 
     def evaluate_train(self, pred, mask=None):
-        idx = self.labels_train['mask'][mask]
-        assert np.all(self.labels_train['mask'][mask])
-        y_true = self.labels_train['data'][mask]
+        idx = np.arange(self.nodes['total'])[mask]
+        assert np.all(np.isin(idx, self.labels_train['nodes']))
+        y_true = self.get_label_matrix(self.labels_train, idx)
         micro = f1_score(y_true, pred, average='micro')
         macro = f1_score(y_true, pred, average='macro')
         result = {
@@ -187,7 +542,7 @@ class data_loader:
 
     def evaluate(self, pred):
         print(f"{bcolors.WARNING}Warning: If you want to obtain test score, please submit online on biendata.{bcolors.ENDC}")
-        y_true = self.labels_test['data'][self.labels_test['mask']]
+        y_true = self.get_label_matrix(self.labels_test, self.labels_test['nodes'])
         micro = f1_score(y_true, pred, average='micro')
         macro = f1_score(y_true, pred, average='macro')
         result = {
@@ -202,37 +557,57 @@ class data_loader:
             num_classes: total number of labels
             total: total number of labeled data
             count: number of labeled data for each node type
-            data: a numpy matrix with shape (self.nodes['total'], self.labels['num_classes'])
-            mask: to indicate if that node is labeled, if False, that line of data is masked
-        """
-        labels = {'num_classes':0, 'total':0, 'count':Counter(), 'data':None, 'mask':None}
-        nc = 0
-        mask = np.zeros(self.nodes['total'], dtype=bool)
-        data = [None for i in range(self.nodes['total'])]
-        with open(os.path.join(self.path, name), 'r', encoding='utf-8') as f:
-            for line in f:
-                th = line.split('\t')
-                node_id, node_name, node_type, node_label = int(th[0]), th[1], int(th[2]), list(map(int, th[3].split(',')))
-                for label in node_label:
-                    nc = max(nc, label+1)
-                mask[node_id] = True
-                data[node_id] = node_label
-                labels['count'][node_type] += 1
-                labels['total'] += 1
-        labels['num_classes'] = nc
-        new_data = np.zeros((self.nodes['total'], labels['num_classes']), dtype=int)
-        for i,x in enumerate(data):
-            if x is not None:
-                for j in x:
-                    new_data[i, j] = 1
-        labels['data'] = new_data
-        labels['mask'] = mask
+            nodes: sorted ids of the labeled nodes
+            classes: class of each labeled node, or the concatenated class lists for multi-label data
+            indptr: None for single-label data, otherwise classes[indptr[i]:indptr[i+1]] belong to nodes[i]
+        use get_label_matrix for dense one-hot rows
+        """
+        labels = {'num_classes':0, 'total':0, 'count':Counter(), 'nodes':None, 'classes':None, 'indptr':None}
+        node_ids, node_types, label_lens, label_vals = [], [], [], []
+        for chunk in read_chunks(os.path.join(self.path, name)):
+            th = np.array(label_pattern.findall(chunk), dtype=str).reshape(-1, 3)
+            if len(th) != count_lines(chunk):
+                raise Exception("Too few information to parse!")
+            node_ids.append(th[:, 0].astype(np.int64))
+            node_types.append(th[:, 1].astype(np.int64))
+            label_lens.append(np.char.count(th[:, 2], ',') + 1)
+            label_vals.append(np.fromstring(','.join(th[:, 2]), dtype=np.int64, sep=','))
+        node_ids = np.concatenate(node_ids) if len(node_ids) else np.zeros(0, dtype=np.int64)
+        node_types = np.concatenate(node_types) if len(node_types) else np.zeros(0, dtype=np.int64)
+        label_lens = np.concatenate(label_lens) if len(label_lens) else np.zeros(0, dtype=np.int64)
+        label_vals = np.concatenate(label_vals) if len(label_vals) else np.zeros(0, dtype=np.int64)
+        if len(label_vals) != label_lens.sum():
+            raise Exception("Too few information to parse!")
+
+        for node_type, cnt in zip(*np.unique(node_types, return_counts=True)):
+            labels['count'][int(node_type)] = int(cnt)
+        labels['total'] = len(node_ids)
+        labels['num_classes'] = int(label_vals.max()) + 1 if len(label_vals) else 0
+        # one CSR row per labeled node, repeated lines and classes are merged
+        nodes = np.unique(node_ids)
+        rows = np.searchsorted(nodes, np.repeat(node_ids, label_lens))
+        mat = sp.csr_matrix((np.ones(len(label_vals), dtype=np.int64), (rows, label_vals)),
+                            shape=(len(nodes), max(labels['num_classes'], 1)))
+        mat.sum_duplicates()
+        mat.sort_indices()
+        labels['nodes'] = nodes
+        labels['classes'] = mat.indices.astype(np.int64)
+        if np.any(np.diff(mat.indptr) != 1):
+            labels['indptr'] = mat.indptr.astype(np.int64)
         return labels
 
     def get_node_type(self, node_id):
-        for i in range(len(self.nodes['shift'])):
-            if node_id < self.nodes['shift'][i]+self.nodes['count'][i]:
-                return i
+        """
+        node_id can be a single id or an array of ids, types are found by binary search over the shifts
+        ids outside [0, total) get None, or -1 in an array
+        """
+        shift = np.array([self.nodes['shift'][i] for i in range(len(self.nodes['shift']))])
+        node_id = np.asarray(node_id)
+        node_type = np.searchsorted(shift, node_id, side='right') - 1
+        node_type = np.where((node_id >= 0) & (node_id < self.nodes['total']), node_type, -1)
+        if np.ndim(node_type) == 0:
+            return None if node_type < 0 else int(node_type)
+        return node_type
 
     def get_edge_type(self, info):
         if type(info) is int or len(info) == 1:
@@ -263,22 +638,29 @@ class data_loader:
             meta: a dict of tuple, explaining the link type is from what type of node to what type of node
             data: a dict of sparse matrices, each link type with one matrix. Shapes are all (nodes['total'], nodes['total'])
         """
-        links = {'total':0, 'count':Counter(), 'meta':{}, 'data':defaultdict(list)}
-        with open(os.path.join(self.path, 'link.dat'), 'r', encoding='utf-8') as f:
-            for line in f:
-                th = line.split('\t')
-                h_id, t_id, r_id, link_weight = int(th[0]), int(th[1]), int(th[2]), float(th[3])
-                if r_id not in links['meta']:
-                    h_type = self.get_node_type(h_id)
-                    t_type = self.get_node_type(t_id)
-                    links['meta'][r_id] = (h_type, t_type)
-                links['data'][r_id].append((h_id, t_id, link_weight))
-                links['count'][r_id] += 1
-                links['total'] += 1
-        new_data = {}
-        for r_id in links['data']:
-            new_data[r_id] = self.list_to_sp_mat(links['data'][r_id])
-        links['data'] = new_data
+        links = {'total':0, 'count':Counter(), 'meta':{}, 'data':{}}
+        h_ids, t_ids, r_ids, link_weights = [], [], [], []
+        for chunk in read_chunks(os.path.join(self.path, 'link.dat')):
+            th = np.fromstring(chunk, sep=' ')
+            if th.size % 4:
+                raise Exception("Too few information to parse!")
+            th = th.reshape(-1, 4)
+            h_ids.append(th[:, 0].astype(np.int64))
+            t_ids.append(th[:, 1].astype(np.int64))
+            r_ids.append(th[:, 2].astype(np.int64))
+            link_weights.append(th[:, 3])
+        h_ids, t_ids = np.concatenate(h_ids), np.concatenate(t_ids)
+        r_ids, link_weights = np.concatenate(r_ids), np.concatenate(link_weights)
+
+        # keep link types in the order they first appear in link.dat
+        uniq, first = np.unique(r_ids, return_index=True)
+        for r_id, beg in zip(uniq[np.argsort(first)].tolist(), np.sort(first).tolist()):
+            sel = np.nonzero(r_ids == r_id)[0]
+            links['meta'][r_id] = (self.get_node_type(h_ids[beg]), self.get_node_type(t_ids[beg]))
+            links['data'][r_id] = sp.coo_matrix((link_weights[sel], (h_ids[sel], t_ids[sel])),
+                                                shape=(self.nodes['total'], self.nodes['total'])).tocsr()
+            links['count'][r_id] = len(sel)
+            links['total'] += len(sel)
         return links
 
     def load_nodes(self):
@@ -291,39 +673,42 @@ class data_loader:
                         [ shift[node_type], shift[node_type]+count[node_type] )
         """
         nodes = {'total':0, 'count':Counter(), 'attr':{}, 'shift':{}}
-        with open(os.path.join(self.path, 'node.dat'), 'r', encoding='utf-8') as f:
-            for line in f:
-                th = line.split('\t')
-                if len(th) == 4:
-                    # Then this line of node has attribute
-                    node_id, node_name, node_type, node_attr = th
-                    node_id = int(node_id)
-                    node_type = int(node_type)
-                    node_attr = list(map(float, node_attr.split(',')))
-                    nodes['count'][node_type] += 1
-                    nodes['attr'][node_id] = node_attr
-                    nodes['total'] += 1
-                elif len(th) == 3:
-                    # Then this line of node doesn't have attribute
-                    node_id, node_name, node_type = th
-                    node_id = int(node_id)
-                    node_type = int(node_type)
-                    nodes['count'][node_type] += 1
-                    nodes['total'] += 1
-                else:
-                    raise Exception("Too few information to parse!")
+        node_ids, node_types, attr_lens, attr_vals = [], [], [], []
+        for chunk in read_chunks(os.path.join(self.path, 'node.dat'), binary=True):
+            ids, types, lens, vals = parse_node_chunk(chunk)
+            node_ids.append(ids)
+            node_types.append(types)
+            attr_lens.append(lens)
+            attr_vals.append(vals)
+        node_ids, node_types = np.concatenate(node_ids), np.concatenate(node_types)
+        attr_lens, attr_vals = np.concatenate(attr_lens), np.concatenate(attr_vals)
+        if len(attr_vals) != attr_lens.sum():
+            raise Exception("Too few information to parse!")
+        attr_offsets = np.concatenate(([0], np.cumsum(attr_lens)))
+
+        # position of each node id in node.dat
+        nodes['total'] = len(node_ids)
+        pos = np.empty(nodes['total'], dtype=np.int64)
+        pos[node_ids] = np.arange(nodes['total'])
+
         shift = 0
-        attr = {}
-        for i in range(len(nodes['count'])):
+        for i, cnt in enumerate(np.bincount(node_types).tolist()):
+            nodes['count'][i] = cnt
             nodes['shift'][i] = shift
-            if shift in nodes['attr']:
-                mat = []
-                for j in range(shift, shift+nodes['count'][i]):
-                    mat.append(nodes['attr'][j])
-                attr[i] = np.array(mat)
+            if cnt == 0:
+                # type ids missing from node.dat
+                nodes['attr'][i] = None
+                continue
+            p = pos[shift:shift+cnt]
+            dim = attr_lens[p[0]]
+            if dim == 0:
+                nodes['attr'][i] = None
+            elif np.all(attr_lens[p] == dim) and np.all(np.diff(p) == 1):
+                # the common case: nodes of one type are stored contiguously in node.dat
+                nodes['attr'][i] = attr_vals[attr_offsets[p[0]]:attr_offsets[p[0]]+cnt*dim].reshape(cnt, dim)
+            elif np.all(attr_lens[p] == dim):
+                nodes['attr'][i] = attr_vals[attr_offsets[p][:, None] + np.arange(dim)]
             else:
-                attr[i] = None
-            shift += nodes['count'][i]
-        nodes['attr'] = attr
+                raise Exception(f"Inconsistent attribute length for node type {i}!")
+            shift += cnt
         return nodes
-
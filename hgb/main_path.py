@@ -17,13 +17,10 @@ def main(args):
     if args.seed > 0:
         set_random_seed(args.seed)
 
-    g, adjs, init_labels, num_classes, dl, train_nid, val_nid, test_nid, test_nid_full \
-        = load_dataset(args)
-
-    for k in adjs.keys():
-        adjs[k].storage._value = None
-        adjs[k].storage._value = torch.ones(adjs[k].nnz()) / adjs[k].sum(dim=-1)[adjs[k].storage.row()]
+    g, adjs, init_labels, num_classes, dl, train_nid, val_nid, test_nid, test_nid_full, identity_types, sparse_feats \
+        = load_dataset(args, *archs[args.arch])
 
+    # adjs is a RelationStore, which row-normalizes every relation itself
     # =======
     # rearange node idx (for feats & labels)
     # =======
@@ -82,12 +79,32 @@ def main(args):
     else:
         max_length = args.num_hops + 1
 
-    g = hg_propagate_feat_dgl_path(g, tgt_type, args.num_hops, max_length, archs[args.arch][0], echo=False)
-    feats = {}
-    keys = list(g.nodes[tgt_type].data.keys())
-    print(f'For tgt {tgt_type}, feature keys {keys}')
-    for k in keys:
-        feats[k] = g.nodes[tgt_type].data.pop(k)
+    # propagation does not depend on the seed, so it is cached across seeds and runs
+    cache_dir, cache_key = prop_cache_dir(args, dl)
+    src_types = [ntype for ntype in g.ntypes if ntype in g.nodes[ntype].data] + list(sparse_feats)
+    path_keys = [k for k in metapath_keys(g, tgt_type, args.num_hops, src_types) if k in archs[args.arch][0] or k == tgt_type]
+    feats = None
+    if not args.no_prop_cache:
+        feats = load_prop_cache(cache_dir, cache_key, path_keys)
+    if feats is not None:
+        print(f'For tgt {tgt_type}, load cached feature keys {list(feats.keys())} from {cache_dir}')
+    else:
+        g = hg_propagate_feat_dgl_path(g, tgt_type, args.num_hops, max_length, archs[args.arch][0], echo=False, backend=args.prop_backend,
+                                       sparse_feats=sparse_feats, fill_threshold=args.sparse_fill_threshold)
+        feats = {}
+        keys = list(g.nodes[tgt_type].data.keys())
+        print(f'For tgt {tgt_type}, feature keys {keys}')
+        for k in keys:
+            feats[k] = g.nodes[tgt_type].data.pop(k)
+        if len(sparse_feats):
+            print(f'For tgt {tgt_type}, sparse feature keys {list(sparse_feats.keys())}')
+            feats.update(sparse_feats)
+        print(f'For tgt {tgt_type}, implicit identity keys {[k for k in feats if k[-1] in identity_types]}')
+        # the order of propagating every type through DGL
+        rank = {k: i for i, k in enumerate(path_keys)}
+        feats = {k: feats[k] for k in sorted(feats, key=lambda k: rank.get(k, len(rank)))}
+        if not args.no_prop_cache:
+            save_prop_cache(cache_dir, cache_key, feats)
 
     if args.dataset in ['DBLP', 'ACM', 'IMDB']:
         data_size = {k: v.size(-1) for k, v in feats.items()}
@@ -158,7 +175,8 @@ def main(args):
             prop_tic = datetime.datetime.now()
 
             meta_adjs = hg_propagate_sparse_pyg(
-                adjs, tgt_type, args.num_label_hops, max_length, extra_metapath, prop_feats=False, echo=False, prop_device=prop_device)
+                adjs, tgt_type, args.num_label_hops, max_length, extra_metapath, prop_feats=False, echo=False, prop_device=prop_device,
+                num_threads=args.spgemm_threads, order=args.spgemm_order)
 
             for k, v in tqdm(meta_adjs.items()):
                 label_feats[k] = remove_diag(v) @ label_onehot
@@ -420,6 +438,24 @@ def parse_args(args=None):
     parser.add_argument("--eps", type=float, default=0)   #1e-12
     parser.add_argument("--ACM_keep_F", action='store_true', default=False,
                         help="whether to use Field type")
+    parser.add_argument("--no-graph-cache", action='store_true', default=False,
+                        help="rebuild and re-validate the graph instead of loading the validated graph cache")
+    parser.add_argument("--no-prop-cache", action='store_true', default=False,
+                        help="always propagate features instead of reusing the propagated feature cache")
+    parser.add_argument("--prop_cache_dir", type=str, default='',
+                        help="where to keep propagated features (default: the dataset directory)")
+    parser.add_argument("--sparse_feat_threshold", type=float, default=0,
+                        help="keep raw attributes with a smaller fraction of non-zeros sparse during propagation (0 to keep all dense)")
+    parser.add_argument("--sparse_fill_threshold", type=float, default=0.1,
+                        help="densify a sparse propagated feature once its fraction of non-zeros exceeds this")
+    parser.add_argument("--spgemm_threads", type=int, default=1,
+                        help="threads of the cpu sparse products building metapath adjs, each one multiplies a block of rows")
+    parser.add_argument("--spgemm_order", type=str, default='suffix', choices=['suffix', 'chain'],
+                        help="build metapath adjs as relation @ suffix, or in the association with the fewest estimated flops (cpu only)")
+    parser.add_argument("--prop-backend", type=str, default='dgl', choices=['dgl', 'csr'],
+                        help="feature propagation with DGL update_all, or with row-normalized CSR operators built once per relation")
+    parser.add_argument("--schema_types", type=str, default='',
+                        help="only load relations and features among these node types, e.g. APT for DBLP (empty for all)")
 
     return parser.parse_args(args)
 
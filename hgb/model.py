@@ -145,12 +145,15 @@ class LDMLP(nn.Module):
                     nn.init.zeros_(layer.bias)
 
     def forward(self, batch, feature_dict, label_dict={}, mask=None):
-        if isinstance(feature_dict[self.tgt_type], torch.Tensor):
-            mapped_feats = {k: self.input_drop(x @ self.embeding[k]) for k, x in feature_dict.items()}  # @矩阵-向量乘法
-        elif isinstance(feature_dict[self.tgt_type], SparseTensor):
-            mapped_feats = {k: self.input_drop(x @ self.embeding[k[-1]]) for k, x in feature_dict.items()}
-        else:
-            assert 0
+        mapped_feats = {}
+        for k, x in feature_dict.items():
+            # sparse propagated attributes have their own embedding, Freebase adjs share the one of their src type
+            if isinstance(x, torch.Tensor) or k in self.embeding:
+                mapped_feats[k] = self.input_drop(x @ self.embeding[k])  # @矩阵-向量乘法
+            elif isinstance(x, SparseTensor):
+                mapped_feats[k] = self.input_drop(x @ self.embeding[k[-1]])
+            else:
+                assert 0
 
         mapped_label_feats = {k: self.input_drop(x @ self.labels_embeding[k]) for k, x in label_dict.items()}
 
@@ -83,16 +83,15 @@ class LHMLP_Se(nn.Module):
     def forward(self, epoch_sampled, feats_dict, label_feats_dict, meta_path_sampled, label_meta_path_sampled):
 
 
-        if isinstance(feats_dict[meta_path_sampled[-1]], torch.Tensor):
-            for k, v in feats_dict.items():
+        for k, v in feats_dict.items():
+            # implicit identity features of DBLP/IMDB/ACM are SparseTensors with their own embedding,
+            # Freebase metapath adjs share the embedding of their source type
+            if isinstance(v, torch.Tensor) or k in self.embeding:
                 feats_dict[k] = self.input_drop(v @ self.embeding[k])
-            
-        elif isinstance(feats_dict[meta_path_sampled[-1]], SparseTensor):
-            for k, v in feats_dict.items():
+            elif isinstance(v, SparseTensor):
                 feats_dict[k] = self.input_drop(v @ self.embeding[k[-1]])
-            
-        else:
-            assert 0
+            else:
+                assert 0
 
 
 
@@ -0,0 +1,420 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import scipy.sparse as sp
+import torch
+from torch_sparse import SparseTensor
+
+
+def index_dtype(max_value):
+    '''
+    int32 if indices up to max_value fit in it, otherwise int64
+    '''
+    return np.int32 if max_value < np.iinfo(np.int32).max else np.int64
+
+
+class CSRAdj:
+    '''
+    CSR adjacency [num dst nodes, num src nodes] whose indptr/indices are int32 whenever sizes allow.
+    value is None for an all-ones adjacency. SpGEMM runs through scipy (which keeps int32 indices)
+    and SpMM with dense features through a torch CSR tensor, so no int64 copy of the indices is made.
+    Arrays that already have the right dtype are shared, not copied, and are never modified in place
+    '''
+    def __init__(self, indptr, indices, value, sparse_sizes):
+        self.sparse_sizes = (int(sparse_sizes[0]), int(sparse_sizes[1]))
+        dtype = index_dtype(max(len(indices), self.sparse_sizes[1]))
+        self.indptr = np.asarray(indptr, dtype=dtype)
+        self.indices = np.asarray(indices, dtype=dtype)
+        self.value = None if value is None else np.asarray(value, dtype=np.float32)
+        self.ones = None
+
+    @classmethod
+    def from_scipy(cls, mat):
+        mat = mat.tocsr()
+        mat.sort_indices()
+        return cls(mat.indptr, mat.indices, mat.data, mat.shape)
+
+    @classmethod
+    def eye(cls, n):
+        return cls(np.arange(n + 1), np.arange(n), None, (n, n))
+
+    @classmethod
+    def from_sparse_tensor(cls, adj):
+        rowptr, col, value = adj.csr()
+        return cls(rowptr.numpy(), col.numpy(), None if value is None else value.numpy(), adj.sparse_sizes())
+
+    def nnz(self):
+        return len(self.indices)
+
+    def size(self, dim):
+        return self.sparse_sizes[dim]
+
+    def row(self):
+        return np.repeat(np.arange(self.sparse_sizes[0], dtype=self.indices.dtype), np.diff(self.indptr))
+
+    def ones_value(self):
+        if self.value is not None:
+            return self.value
+        # built once, SpGEMM and SpMM of an all-ones adj use it every time
+        if self.ones is None:
+            self.ones = np.ones(self.nnz(), dtype=np.float32)
+        return self.ones
+
+    def row_mean(self):
+        '''
+        Row-normalized copy sharing the index arrays, (adj @ x) becomes the mean of x over each row
+        '''
+        value = self.ones_value()
+        deg = np.bincount(self.row(), weights=value, minlength=self.sparse_sizes[0])
+        value = value / np.repeat(np.maximum(deg, 1).astype(np.float32), np.diff(self.indptr))
+        return CSRAdj(self.indptr, self.indices, value, self.sparse_sizes)
+
+    def to_scipy(self):
+        return sp.csr_matrix((self.ones_value(), self.indices, self.indptr), shape=self.sparse_sizes)
+
+    def to_sparse_tensor(self):
+        return SparseTensor(rowptr=torch.from_numpy(self.indptr.astype(np.int64)),
+                            col=torch.from_numpy(self.indices.astype(np.int64)),
+                            value=None if self.value is None else torch.from_numpy(self.value),
+                            sparse_sizes=self.sparse_sizes, is_sorted=True)
+
+    def to_dense(self):
+        return torch.from_numpy(self.to_scipy().toarray())
+
+    def density(self):
+        return self.nnz() / max(self.sparse_sizes[0] * self.sparse_sizes[1], 1)
+
+    def rows(self, beg, end):
+        '''
+        rows [beg, end) as a [end - beg, num src nodes] CSRAdj
+        '''
+        lo, hi = self.indptr[beg], self.indptr[end]
+        return CSRAdj(self.indptr[beg:end+1] - lo, self.indices[lo:hi],
+                      None if self.value is None else self.value[lo:hi], (end - beg, self.sparse_sizes[1]))
+
+    @staticmethod
+    def vstack(blocks):
+        indptr = [np.zeros(1, dtype=np.int64)]
+        offset = 0
+        for block in blocks:
+            indptr.append(block.indptr[1:].astype(np.int64) + offset)
+            offset += block.nnz()
+        value = None
+        if any(block.value is not None for block in blocks):
+            value = np.concatenate([block.ones_value() for block in blocks])
+        return CSRAdj(np.concatenate(indptr), np.concatenate([block.indices for block in blocks]), value,
+                      (sum(block.size(0) for block in blocks), blocks[0].size(1)))
+
+    def t(self):
+        return CSRAdj.from_scipy(self.to_scipy().T)
+
+    def remove_diag(self):
+        row = self.row()
+        keep = row != self.indices
+        indptr = np.zeros(self.sparse_sizes[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row[keep], minlength=self.sparse_sizes[0]), out=indptr[1:])
+        return CSRAdj(indptr, self.indices[keep], None if self.value is None else self.value[keep], self.sparse_sizes)
+
+    def prune(self, topk=0, nnz_budget=0):
+        '''
+        Keep the topk largest entries of every row, then the nnz_budget largest ones overall (0 for no limit).
+        Ties go to the smaller column (and row), so the result does not depend on how the product was computed
+        '''
+        if topk <= 0 and nnz_budget <= 0:
+            return self
+        value = self.ones_value()
+        row = self.row()
+        keep = np.ones(self.nnz(), dtype=bool)
+        if topk > 0 and np.diff(self.indptr).max(initial=0) > topk:
+            order = np.lexsort((self.indices, -value, row))
+            rank = np.arange(self.nnz()) - self.indptr[row[order]]
+            keep[order[rank >= topk]] = False
+        if nnz_budget > 0 and keep.sum() > nnz_budget:
+            idx = np.flatnonzero(keep)
+            order = np.lexsort((self.indices[idx], row[idx], -value[idx]))
+            keep[idx[order[nnz_budget:]]] = False
+        if keep.all():
+            return self
+        indptr = np.zeros(self.sparse_sizes[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row[keep], minlength=self.sparse_sizes[0]), out=indptr[1:])
+        return CSRAdj(indptr, self.indices[keep], value[keep], self.sparse_sizes)
+
+    def matmul(self, other):
+        '''
+        CSRAdj @ CSRAdj gives a CSRAdj, CSRAdj @ dense Tensor gives a dense Tensor
+        '''
+        if isinstance(other, (CSRAdj, RelationView)):
+            return CSRAdj.from_scipy(self.to_scipy().dot(other.to_scipy()))
+        csr = torch.sparse_csr_tensor(torch.from_numpy(self.indptr), torch.from_numpy(self.indices),
+                                      torch.from_numpy(self.ones_value()).to(other.dtype), size=self.sparse_sizes)
+        return csr @ other
+
+    def __matmul__(self, other):
+        return self.matmul(other)
+
+    def __repr__(self):
+        return f'CSRAdj(sparse_sizes={self.sparse_sizes}, nnz={self.nnz()}, index_dtype={self.indices.dtype})'
+
+
+class RelationView:
+    '''
+    One direction of a relation in a RelationStore, backed by the stored arrays (see RelationStore.scipy)
+    '''
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+
+    def to_csr(self):
+        return self.store.csr(self.key)
+
+    def to_scipy(self):
+        return self.store.scipy(self.key)
+
+    def to_sparse_tensor(self):
+        return self.to_csr().to_sparse_tensor()
+
+    def structure(self):
+        return self.store.structure(self.key)
+
+    def size(self, dim):
+        if self.key in self.store.adjs:
+            return self.store.adjs[self.key].size(dim)
+        return self.store.adjs[self.store.reverse_of[self.key]].size(1 - dim)
+
+    def matmul(self, other):
+        return self.store.matmul(self.key, other)
+
+    def __matmul__(self, other):
+        return self.matmul(other)
+
+
+def spgemm(adj_l, adj_r, num_threads=1, num_blocks=0, topk=0):
+    '''
+    adj_l @ adj_r (CSRAdj or RelationView) with the rows of adj_l split into blocks of about the same nnz,
+    multiplied in a thread pool (scipy's SpGEMM releases the GIL) and stacked back into one CSRAdj.
+    Every block is pruned to topk entries per row (see CSRAdj.prune) as soon as it is built.
+    num_blocks 0 gives 4 blocks per thread
+    '''
+    if num_threads <= 1:
+        return adj_l.matmul(adj_r).prune(topk)
+    # row blocks need the left side in CSR, a reverse relation is converted for this product only
+    adj_l = adj_l.to_csr() if isinstance(adj_l, RelationView) else adj_l
+    if adj_l.size(0) == 0:
+        return adj_l.matmul(adj_r)
+    right = adj_r.to_scipy().tocsr()
+    num_blocks = num_blocks or 4 * num_threads
+    bounds = np.searchsorted(adj_l.indptr, np.linspace(0, adj_l.nnz(), num_blocks + 1)[1:-1])
+    bounds = np.unique(np.concatenate([[0], bounds, [adj_l.size(0)]]))
+
+    def run(i):
+        block = adj_l.rows(bounds[i], bounds[i+1])
+        return CSRAdj.from_scipy(block.to_scipy().dot(right)).prune(topk)
+
+    with ThreadPoolExecutor(num_threads) as pool:
+        blocks = list(pool.map(run, range(len(bounds) - 1)))
+    return CSRAdj.vstack(blocks)
+
+
+class ChainEstimator:
+    '''
+    nnz estimates of metapath adj products (keys like '0120') from the relation structures alone.
+    Each flop of a row is assumed to hit one of its p columns at random, so a row with f flops has
+    about p * (1 - exp(-f / p)) non-zeros. Row and column counts are built by SpMV along the relations
+    '''
+    def __init__(self, relations):
+        self.structure = {}
+        for k, adj in relations.items():
+            if isinstance(adj, RelationView):
+                self.structure[k] = adj.structure()
+            else:
+                self.structure[k] = sp.csr_matrix((np.ones(adj.nnz(), dtype=np.float32), adj.indices, adj.indptr),
+                                                  shape=adj.sparse_sizes)
+        self.row_counts, self.col_counts = {}, {}
+
+    @staticmethod
+    def fill(flops, p):
+        return p * -np.expm1(-flops / p)
+
+    def row_nnz(self, key):
+        if key not in self.row_counts:
+            if len(key) == 2:
+                self.row_counts[key] = self.structure[key].getnnz(axis=1).astype(np.float64)
+            else:
+                flops = self.structure[key[:2]] @ self.row_nnz(key[1:])
+                self.row_counts[key] = self.fill(flops, self.structure[key[-2:]].shape[1])
+        return self.row_counts[key]
+
+    def col_nnz(self, key):
+        if key not in self.col_counts:
+            if len(key) == 2:
+                self.col_counts[key] = self.structure[key].getnnz(axis=0).astype(np.float64)
+            else:
+                flops = self.structure[key[-2:]].T @ self.col_nnz(key[:-1])
+                self.col_counts[key] = self.fill(flops, self.structure[key[:2]].shape[0])
+        return self.col_counts[key]
+
+    def flops(self, key, split):
+        '''
+        multiplications of key[:split+1] @ key[split:]
+        '''
+        return float(self.col_nnz(key[:split+1]) @ self.row_nnz(key[split:]))
+
+
+def plan_matrix_chain(targets, estimator, resident=()):
+    '''
+    Cheapest association of the products of every target by the estimated flops (see ChainEstimator).
+    Keys already there, resident ones or ones built for an earlier target, cost nothing,
+    so sub-products shared between targets are built once. Ties keep the relation on the left,
+    the order of plan_propagation. A key that is not a target is freed after its last use.
+
+    return the steps [('build', key, split) or ('free', key, None)], key = key[:split+1] @ key[split:],
+    and the estimated flops
+    '''
+    targets = list(dict.fromkeys(targets))
+    available = set(resident)
+    builds = []
+    total = 0.
+    for key in targets:
+        memo = {}
+
+        def best(k):
+            if len(k) == 2 or k in available:
+                return 0., None
+            if k not in memo:
+                memo[k] = min((best(k[:m+1])[0] + best(k[m:])[0] + estimator.flops(k, m), m)
+                              for m in range(1, len(k) - 1))
+            return memo[k]
+
+        def expand(k):
+            if len(k) == 2 or k in available:
+                return
+            split = best(k)[1]
+            expand(k[:split+1])
+            expand(k[split:])
+            builds.append((k, split))
+            available.add(k)
+
+        total += best(key)[0]
+        expand(key)
+
+    uses = {}
+    for k, split in builds:
+        for part in (k[:split+1], k[split:]):
+            uses[part] = uses.get(part, 0) + 1
+    live = set(resident)
+    keep = set(targets)
+    steps = [('free', k, None) for k in resident if k not in keep and k not in uses]
+    for k, split in builds:
+        steps.append(('build', k, split))
+        live.add(k)
+        for part in (k[:split+1], k[split:]):
+            uses[part] -= 1
+            if uses[part] == 0 and part in live and part not in keep:
+                steps.append(('free', part, None))
+                live.discard(part)
+    return steps, total
+
+
+class RelationStore:
+    '''
+    Row-normalized (mean aggregation) relation adjs keyed like 'AP' (rows A, cols P).
+    Each edge set is kept once as a CSRAdj without values. The reverse key ('PA') is the transpose of the
+    same arrays, a CSC view, normalized by the in-degrees of the stored adj. Values are never stored,
+    products are taken over the all-ones structure and their rows scaled by 1/degree afterwards
+    '''
+    def __init__(self):
+        self.adjs = {}
+        self.reverse_of = {}
+        self.inv_deg = {}
+        self.order = []
+
+    @classmethod
+    def from_adjs(cls, adjs):
+        '''
+        adjs is a dict of SparseTensors, only their structure is used.
+        A key whose reversed key is already stored shares its arrays if it is exactly the transpose
+        '''
+        store = cls()
+        for k, adj in adjs.items():
+            rowptr, col, _ = adj.csr()
+            csr = CSRAdj(rowptr.numpy(), col.numpy(), None, adj.sparse_sizes())
+            if k[::-1] != k and k[::-1] in store.adjs and store.is_transpose(k[::-1], csr):
+                store.reverse_of[k] = k[::-1]
+            else:
+                store.adjs[k] = csr
+            store.order.append(k)
+        return store
+
+    def is_transpose(self, key, csr):
+        adj = self.adjs[key]
+        if csr.sparse_sizes != adj.sparse_sizes[::-1] or csr.nnz() != adj.nnz():
+            return False
+        # converting the CSC view gives sorted indices, a transient copy at load time only
+        t = adj.to_scipy().T.tocsr()
+        return np.array_equal(t.indptr, csr.indptr) and np.array_equal(t.indices, csr.indices)
+
+    def keys(self):
+        return list(self.order)
+
+    def __contains__(self, key):
+        return key in self.adjs or key in self.reverse_of
+
+    def __len__(self):
+        return len(self.order)
+
+    def structure(self, key):
+        '''
+        All-ones scipy matrix of key over the stored arrays, CSR for stored keys and CSC for reverse keys
+        '''
+        if key in self.adjs:
+            return self.adjs[key].to_scipy()
+        return self.adjs[self.reverse_of[key]].to_scipy().T
+
+    def inv_degree(self, key):
+        if key not in self.inv_deg:
+            if key in self.adjs:
+                deg = np.diff(self.adjs[key].indptr)
+            else:
+                adj = self.adjs[self.reverse_of[key]]
+                deg = np.bincount(adj.indices, minlength=adj.size(1))
+            self.inv_deg[key] = 1 / np.maximum(deg, 1).astype(np.float32)
+        return self.inv_deg[key]
+
+    def scipy(self, key):
+        '''
+        Row-normalized scipy matrix of key over the stored index arrays, only the values are new
+        '''
+        mat = self.structure(key)
+        inv_deg = self.inv_degree(key)
+        # rows of a reverse key are the stored column indices
+        value = np.repeat(inv_deg, np.diff(mat.indptr)) if key in self.adjs else inv_deg[mat.indices]
+        return type(mat)((value, mat.indices, mat.indptr), shape=mat.shape)
+
+    def csr(self, key):
+        '''
+        Row-normalized CSRAdj of key, sharing the stored arrays for stored keys and a transposed copy for reverse keys
+        '''
+        if key in self.adjs:
+            return self.adjs[key].row_mean()
+        return CSRAdj.from_scipy(self.scipy(key))
+
+    def matmul(self, key, other):
+        '''
+        Row-normalized key @ other (a dense Tensor, CSRAdj or RelationView), the structure is multiplied
+        and the rows of the result scaled by 1/degree. A reverse key is converted to CSR only for sparse
+        products and only while they run
+        '''
+        mat = self.structure(key)
+        inv_deg = self.inv_degree(key)
+        if isinstance(other, torch.Tensor):
+            out = mat @ other.numpy()
+            out *= inv_deg[:, None].astype(out.dtype)
+            return torch.from_numpy(out)
+        out = mat.tocsr().dot(other.to_scipy())
+        out.data *= np.repeat(inv_deg, np.diff(out.indptr))
+        return CSRAdj.from_scipy(out)
+
+    def items(self):
+        return [(k, RelationView(self, k)) for k in self.order]
+
+    def __getitem__(self, key):
+        return self.csr(key).to_sparse_tensor()
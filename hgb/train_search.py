@@ -20,13 +20,10 @@ def main(args):
     if args.seed > 0:
         set_random_seed(args.seed)
 
-    g, adjs, init_labels, num_classes, dl, train_nid, val_nid, test_nid, test_nid_full \
+    g, adjs, init_labels, num_classes, dl, train_nid, val_nid, test_nid, test_nid_full, identity_types, sparse_feats \
         = load_dataset(args)
 
-    for k in adjs.keys():
-        adjs[k].storage._value = None
-        adjs[k].storage._value = torch.ones(adjs[k].nnz()) / adjs[k].sum(dim=-1)[adjs[k].storage.row()]
-
+    # adjs is a RelationStore, which row-normalizes every relation itself
     # =======
     # rearange node idx (for feats & labels)
     # =======
@@ -81,7 +78,10 @@ def main(args):
 
     print(f'Current num hops = {args.num_hops}')
 
-    if args.dataset == 'Freebase':
+    if args.dataset == 'Freebase' and (args.prop_topk > 0 or args.prop_nnz_budget > 0 or args.spgemm_order == 'chain'):
+        # pruned or chain ordered metapath adjs are built on cpu
+        prop_device = 'cpu'
+    elif args.dataset == 'Freebase':
         prop_device = 'cuda:{}'.format(args.gpu) if not args.cpu else 'cpu'
     else:
         prop_device = 'cpu'
@@ -91,6 +91,14 @@ def main(args):
         if not os.path.exists('./Freebase_adjs'):
             os.makedirs('./Freebase_adjs')
         num_tgt_nodes = dl.nodes['count'][0]
+        prune_suffix = ''
+        if args.prop_topk > 0:
+            prune_suffix += f'_top{args.prop_topk}'
+        if args.prop_nnz_budget > 0:
+            prune_suffix += f'_nnz{args.prop_nnz_budget}'
+        if prune_suffix and args.spgemm_order == 'chain':
+            # pruning depends on the association, exact products do not
+            prune_suffix += '_chain'
 
     # compute k-hop feature
     prop_tic = datetime.datetime.now()
@@ -101,14 +109,34 @@ def main(args):
             max_length = args.num_hops + 1
 
 
-        g = hg_propagate_feat_dgl(g, tgt_type, args.num_hops, max_length, echo=True)
-
-
-        feats = {}
-        keys = list(g.nodes[tgt_type].data.keys())
-        print(f'For tgt {tgt_type}, feature keys {keys}')
-        for k in keys:
-            feats[k] = g.nodes[tgt_type].data.pop(k)
+        # propagation does not depend on the seed, so it is cached across seeds and runs
+        cache_dir, cache_key = prop_cache_dir(args, dl)
+        src_types = [ntype for ntype in g.ntypes if ntype in g.nodes[ntype].data] + list(sparse_feats)
+        all_keys = metapath_keys(g, tgt_type, args.num_hops, src_types)
+        feats = None
+        if not args.no_prop_cache:
+            feats = load_prop_cache(cache_dir, cache_key, all_keys)
+        if feats is not None:
+            print(f'For tgt {tgt_type}, load cached feature keys {list(feats.keys())} from {cache_dir}')
+        else:
+            g = hg_propagate_feat_dgl(g, tgt_type, args.num_hops, max_length, echo=True, backend=args.prop_backend,
+                                      sparse_feats=sparse_feats, fill_threshold=args.sparse_fill_threshold)
+
+
+            feats = {}
+            keys = list(g.nodes[tgt_type].data.keys())
+            print(f'For tgt {tgt_type}, feature keys {keys}')
+            for k in keys:
+                feats[k] = g.nodes[tgt_type].data.pop(k)
+            if len(sparse_feats):
+                print(f'For tgt {tgt_type}, sparse feature keys {list(sparse_feats.keys())}')
+                feats.update(sparse_feats)
+            print(f'For tgt {tgt_type}, implicit identity keys {[k for k in feats if k[-1] in identity_types]}')
+            # the order of propagating every type through DGL, the search samples metapaths by position
+            rank = {k: i for i, k in enumerate(all_keys)}
+            feats = {k: feats[k] for k in sorted(feats, key=lambda k: rank.get(k, len(rank)))}
+            if not args.no_prop_cache:
+                save_prop_cache(cache_dir, cache_key, feats)
 
     else:
         if len(extra_metapath):
@@ -116,7 +144,7 @@ def main(args):
         else:
             max_length = args.num_hops + 1
 
-        save_name = f'./Freebase_adjs/feat_seed{args.seed}_hop{args.num_hops}'
+        save_name = f'./Freebase_adjs/feat_seed{args.seed}_hop{args.num_hops}{prune_suffix}'
         if args.seed > 0 and os.path.exists(f'{save_name}_00_int64.npy'):
             # meta_adjs = torch.load(save_name)
             meta_adjs = {}
@@ -127,7 +155,9 @@ def main(args):
                 meta_adjs.update(tmp.load_adjs(expand=True))
                 del tmp
         else:
-            meta_adjs = hg_propagate_sparse_pyg(adjs, tgt_type, args.num_hops, max_length, extra_metapath, prop_feats=True, echo=True, prop_device=prop_device)
+            meta_adjs = hg_propagate_sparse_pyg(adjs, tgt_type, args.num_hops, max_length, extra_metapath, prop_feats=True, echo=True, prop_device=prop_device,
+                                                topk=args.prop_topk, nnz_budget=args.prop_nnz_budget, num_threads=args.spgemm_threads,
+                                                order=args.spgemm_order)
 
             meta_adj_list = []
             for srcname in dl.nodes['count'].keys():
@@ -237,13 +267,15 @@ def main(args):
                 meta_adjs = {k: v for k, v in meta_adjs.items() if k[-1] == '0' and len(k) < max_length}
             else:
                 if args.dataset == 'Freebase':
-                    save_name = f'./Freebase_adjs/label_seed{args.seed}_hop{args.num_label_hops}'
+                    save_name = f'./Freebase_adjs/label_seed{args.seed}_hop{args.num_label_hops}{prune_suffix}'
                     if args.seed > 0 and os.path.exists(f'{save_name}_int64.npy'):
                         meta_adj_list = SparseAdjList(save_name, None, None, num_tgt_nodes, num_tgt_nodes, with_values=True)
                         meta_adjs = meta_adj_list.load_adjs(expand=True)
                     else:
                         meta_adjs = hg_propagate_sparse_pyg(
-                            adjs, tgt_type, args.num_label_hops, max_length, extra_metapath, prop_feats=False, echo=True, prop_device=prop_device)
+                            adjs, tgt_type, args.num_label_hops, max_length, extra_metapath, prop_feats=False, echo=True, prop_device=prop_device,
+                            topk=args.prop_topk, nnz_budget=args.prop_nnz_budget, num_threads=args.spgemm_threads,
+                            order=args.spgemm_order)
                         meta_adj_list = SparseAdjList(save_name, meta_adjs.keys(), meta_adjs, num_tgt_nodes, num_tgt_nodes, with_values=True)
 
                         tmp = SparseAdjList(save_name, None, None, num_tgt_nodes, num_tgt_nodes, with_values=True)
@@ -259,7 +291,8 @@ def main(args):
                     #     meta_adjs = torch.load(f'./cache/{args.dataset}_label_prop_hop{args.num_label_hops}.pt')
                     # except:
                     meta_adjs = hg_propagate_sparse_pyg(
-                        adjs, tgt_type, args.num_label_hops, max_length, extra_metapath, prop_feats=False, echo=True, prop_device=prop_device)
+                        adjs, tgt_type, args.num_label_hops, max_length, extra_metapath, prop_feats=False, echo=True, prop_device=prop_device,
+                        num_threads=args.spgemm_threads, order=args.spgemm_order)
                     # torch.save(meta_adjs, f'./cache/{args.dataset}_label_prop_hop{args.num_label_hops}.pt')
 
             if args.dataset == 'Freebase':
@@ -529,6 +562,28 @@ def parse_args(args=None):
     parser.add_argument("--num_final", type=int, default=60)
     parser.add_argument("--ACM_keep_F", action='store_true', default=False,
                         help="whether to use Field type")
+    parser.add_argument("--no-graph-cache", action='store_true', default=False,
+                        help="rebuild and re-validate the graph instead of loading the validated graph cache")
+    parser.add_argument("--no-prop-cache", action='store_true', default=False,
+                        help="always propagate features instead of reusing the propagated feature cache")
+    parser.add_argument("--prop_cache_dir", type=str, default='',
+                        help="where to keep propagated features (default: the dataset directory)")
+    parser.add_argument("--sparse_feat_threshold", type=float, default=0,
+                        help="keep raw attributes with a smaller fraction of non-zeros sparse during propagation (0 to keep all dense)")
+    parser.add_argument("--sparse_fill_threshold", type=float, default=0.1,
+                        help="densify a sparse propagated feature once its fraction of non-zeros exceeds this")
+    parser.add_argument("--prop_topk", type=int, default=0,
+                        help="Freebase: keep at most this many entries per row of a metapath adj after every hop (0 for exact products)")
+    parser.add_argument("--prop_nnz_budget", type=int, default=0,
+                        help="Freebase: keep at most this many entries in a metapath adj after every hop (0 for no limit)")
+    parser.add_argument("--spgemm_threads", type=int, default=1,
+                        help="threads of the cpu sparse products building metapath adjs, each one multiplies a block of rows")
+    parser.add_argument("--spgemm_order", type=str, default='suffix', choices=['suffix', 'chain'],
+                        help="build metapath adjs as relation @ suffix, or in the association with the fewest estimated flops (cpu only)")
+    parser.add_argument("--prop-backend", type=str, default='dgl', choices=['dgl', 'csr'],
+                        help="feature propagation with DGL update_all, or with row-normalized CSR operators built once per relation")
+    parser.add_argument("--schema_types", type=str, default='',
+                        help="only load relations and features among these node types, e.g. APT for DBLP (empty for all)")
     return parser.parse_args(args)
 
 if __name__ == '__main__':
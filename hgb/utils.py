@@ -1,6 +1,8 @@
 import os
 import sys
 import gc
+import hashlib
+import json
 import random
 
 import dgl
@@ -19,6 +21,8 @@ from tqdm import tqdm
 
 sys.path.append('../data')
 from data_loader import data_loader
+from sparse_adj import CSRAdj, RelationStore, RelationView, index_dtype, spgemm, ChainEstimator, plan_matrix_chain
+from prop_plan import plan_propagation
 import src.utils_lib
 
 import warnings
@@ -104,140 +108,218 @@ def get_n_params(model):
     return pp
 
 
-def hg_propagate_feat_dgl(g, tgt_type, num_hops, max_length, echo=False):
-    for hop in range(1, max_length):
-        #reserve_heads = [ele[:hop] for ele in extra_metapath if len(ele) > hop]
-
-        for etype in g.etypes:
-            stype, _, dtype = g.to_canonical_etype(etype)
-            # if hop == args.num_hops and dtype != tgt_type: continue
-            for k in list(g.nodes[stype].data.keys()):
-                if len(k) == hop:
-                    current_dst_name = f'{dtype}{k}'
-                    if (hop == num_hops and dtype != tgt_type ) \
-                      or (hop > num_hops):
-                        continue
-                    if echo: print(k, etype, current_dst_name)
-                    g[etype].update_all(
-                        fn.copy_u(k, 'm'),
-                        fn.mean('m', current_dst_name), etype=etype)
-
-        # remove no-use items
-        for ntype in g.ntypes:
-            if ntype == tgt_type: continue
-            removes = []
-            for k in g.nodes[ntype].data.keys():
-                if len(k) <= hop:
-                    removes.append(k)
-            for k in removes:
-                g.nodes[ntype].data.pop(k)
-            if echo and len(removes): print('remove', removes)
-        gc.collect()
-
-        if echo: print(f'-- hop={hop} ---')
-        for ntype in g.ntypes:
-            for k, v in g.nodes[ntype].data.items():
-                print(f'{ntype} {k} {v.shape}', v[:,-1].max(), v[:,-1].mean())
-
-        if echo: print(f'------\n')
-
-    return g
-
-
-def hg_propagate_feat_dgl_path(g, tgt_type, num_hops, max_length, meta_path, echo=False):
-    for hop in range(1, max_length):
-        #reserve_heads = [ele[:hop] for ele in extra_metapath if len(ele) > hop]
-
-        for etype in g.etypes:
-            stype, _, dtype = g.to_canonical_etype(etype)
-
-            for k in list(g.nodes[stype].data.keys()):
-                if len(k) == hop:
-                    # if hop == max_length - 1:
-                    #     import code
-                    #     code.interact(local=locals())
-                    current_dst_name = f'{dtype}{k}'
-                    if (hop == num_hops and dtype != tgt_type ) \
-                      or (hop > num_hops):
-                        continue
-                    if echo: print(k, etype, current_dst_name)
-                    g[etype].update_all(
-                        fn.copy_u(k, 'm'),
-                        fn.mean('m', current_dst_name), etype=etype)
-
-        # remove no-use items
-        for ntype in g.ntypes:
-
-            if ntype == tgt_type: continue
-            removes = []
-            for k in g.nodes[ntype].data.keys():
-
-                if len(k) <= hop:
-                    removes.append(k)
-            for k in removes:
-                g.nodes[ntype].data.pop(k)
-            if echo and len(removes): print('remove', removes)
-        gc.collect()
-
-        if echo:
-            print(f'-- hop={hop} ---')
-            for ntype in g.ntypes:
-                for k, v in g.nodes[ntype].data.items():
-                    print(f'{ntype} {k} {v.shape}', v[:,-1].max(), v[:,-1].mean())
-
-        if echo: print(f'------\n')
+def mean_operator(g, etype):
+    '''
+    Row-normalized CSRAdj [num dst, num src] of etype, operator @ x equals update_all(copy_u, mean)
+    '''
+    stype, _, dtype = etype
+    src, dst = g.edges(etype=etype)
+    adj = sp.csr_matrix((np.ones(len(src), dtype=np.float32), (dst.numpy(), src.numpy())),
+                        shape=(g.num_nodes(dtype), g.num_nodes(stype)))
+    return CSRAdj.from_scipy(adj).row_mean()
+
+
+def hg_propagate_planned(g, tgt_type, targets, echo=False, backend='dgl', sparse_feats=None, fill_threshold=0.1):
+    '''
+    Build the metapath features targets (keys like 'APA', see metapath_keys) at tgt_type,
+    in the order of plan_propagation so every intermediate is dropped right after its last use.
+    backend 'dgl' runs update_all on the node frames, 'csr' multiplies row-normalized operators
+    built once per relation (see mean_operator) and keeps the features out of DGL.
+    Raw features no target needs are dropped too, the targets are left at tgt_type in the order given.
+
+    sparse_feats (see attach_node_feats) are raw CSRAdj features of types not in g, they need the 'csr' backend.
+    Their metapaths are propagated as SpGEMM and turned dense once their density exceeds fill_threshold.
+    The dict is updated in place like g: raw features are taken out and the targets still sparse
+    at the end are put back as SparseTensors
+    '''
+    assert backend in ['dgl', 'csr'], backend
+    sparse_feats = {} if sparse_feats is None else sparse_feats
+    if len(sparse_feats) and backend != 'csr':
+        print(f'Sparse features of {list(sparse_feats.keys())} use the csr propagation backend')
+        backend = 'csr'
+    raw_dims = {ntype: g.nodes[ntype].data[ntype] for ntype in g.ntypes if ntype in g.nodes[ntype].data}
+    raw_dims = {ntype: (feat.shape[1], feat.element_size()) for ntype, feat in raw_dims.items()}
+    raw_dims.update({ntype: (feat.size(1), 4) for ntype, feat in sparse_feats.items()})
+    src_types = list(raw_dims.keys())
+    targets = [k for k in targets if k[-1] in src_types]
+    relations = {f'{dtype}{stype}': (stype, etype, dtype) for stype, etype, dtype in g.canonical_etypes}
+
+    def size_of(k):
+        # dense size, an upper bound for sparse features
+        dim, element_size = raw_dims[k[-1]]
+        return g.num_nodes(k[0]) * dim * element_size
+
+    steps, peak = plan_propagation(targets, size_of, resident=src_types)
+    print(f'Planned {sum(op == "build" for op, _ in steps)} propagations for {len(targets)} metapaths, '
+          f'peak feature memory {peak / 2**20:.1f} MB')
+    if backend == 'csr':
+        feats = {ntype: g.nodes[ntype].data.pop(ntype) for ntype in src_types if ntype not in sparse_feats}
+        feats.update(sparse_feats)
+        sparse_feats.clear()
+        operators = {}
+    for op, k in steps:
+        if op == 'build':
+            etype = relations[k[:2]]
+            if echo: print(k[1:], etype, k)
+            if backend == 'dgl':
+                g[etype].update_all(fn.copy_u(k[1:], 'm'), fn.mean('m', k), etype=etype)
+            else:
+                if k[:2] not in operators:
+                    operators[k[:2]] = mean_operator(g, etype)
+                feats[k] = operators[k[:2]].matmul(feats[k[1:]])
+                if isinstance(feats[k], CSRAdj) and feats[k].density() > fill_threshold:
+                    if echo: print(f'densify {k}, density {feats[k].density():.4f}')
+                    feats[k] = feats[k].to_dense()
+        else:
+            if backend == 'dgl':
+                g.nodes[k[0]].data.pop(k)
+            else:
+                feats.pop(k)
+            if echo: print('remove', k)
+    gc.collect()
 
+    if backend == 'dgl':
+        feats = {k: g.nodes[tgt_type].data.pop(k) for k in targets}
+    else:
+        feats = {k: feats[k] for k in targets}
+    sparse_feats.update({k: v.to_sparse_tensor() for k, v in feats.items() if isinstance(v, CSRAdj)})
+    g.nodes[tgt_type].data.update({k: v for k, v in feats.items() if k not in sparse_feats})
     return g
 
 
-def hg_propagate_sparse_pyg(adjs, tgt_types, num_hops, max_length, extra_metapath, prop_feats=False, echo=False, prop_device='cpu'):
+def hg_propagate_feat_dgl(g, tgt_type, num_hops, max_length, echo=False, backend='dgl', sparse_feats=None, fill_threshold=0.1):
+    src_types = [ntype for ntype in g.ntypes if ntype in g.nodes[ntype].data] + list(sparse_feats or [])
+    return hg_propagate_planned(g, tgt_type, metapath_keys(g, tgt_type, num_hops, src_types), echo=echo,
+                                backend=backend, sparse_feats=sparse_feats, fill_threshold=fill_threshold)
+
+
+def hg_propagate_feat_dgl_path(g, tgt_type, num_hops, max_length, meta_path, echo=False, backend='dgl',
+                               sparse_feats=None, fill_threshold=0.1):
+    '''
+    Like hg_propagate_feat_dgl, but only propagates the keys meta_path needs and only keeps
+    meta_path (and the raw tgt_type features) at tgt_type
+    '''
+    src_types = [ntype for ntype in g.ntypes if ntype in g.nodes[ntype].data] + list(sparse_feats or [])
+    targets = [k for k in metapath_keys(g, tgt_type, num_hops, src_types) if k in meta_path or k == tgt_type]
+    return hg_propagate_planned(g, tgt_type, targets, echo=echo, backend=backend,
+                                sparse_feats=sparse_feats, fill_threshold=fill_threshold)
+
+
+def hg_propagate_sparse_pyg(adjs, tgt_types, num_hops, max_length, extra_metapath, prop_feats=False, echo=False, prop_device='cpu', return_csr=False,
+                            topk=0, nnz_budget=0, num_threads=1, order='suffix'):
+    '''
+    adjs is a RelationStore (see load_dataset) or a dict of SparseTensors.
+    On cpu the metapath adjs are built as CSRAdj (int32 indices) and turned back into SparseTensors
+    at the end, unless return_csr is set.
+
+    topk / nnz_budget (cpu only) approximate the products: after every hop a metapath adj keeps at most
+    topk entries per row and nnz_budget entries in total, the largest weights first (see CSRAdj.prune).
+    Longer metapaths are then built from pruned ones, so the mass each key keeps of its exact adj is printed.
+    num_threads > 1 runs every cpu product as row blocks in a thread pool (see spgemm).
+    order 'suffix' builds every key as its first relation @ its suffix, 'chain' (cpu only) picks the
+    association of each key with the fewest estimated flops and shares sub-products (see plan_matrix_chain)
+    '''
+    assert order in ['suffix', 'chain'], order
     store_device = 'cpu'
     if type(tgt_types) is not list:
         tgt_types = [tgt_types]
 
-    label_feats = {k: v.clone() for k, v in adjs.items() if prop_feats or k[-1] in tgt_types} # metapath should start with target type in label propagation
-    adjs_g = {k: v.to(prop_device) for k, v in adjs.items()}
+    if prop_device == 'cpu' and isinstance(adjs, RelationStore):
+        # relations stay views of the store (reverse ones are transposed views) until they are returned
+        adjs_g = dict(adjs.items())
+        label_feats = {k: v for k, v in adjs_g.items() if prop_feats or k[-1] in tgt_types}
+    elif prop_device == 'cpu':
+        label_feats = {k: CSRAdj.from_sparse_tensor(v) for k, v in adjs.items() if prop_feats or k[-1] in tgt_types}
+        adjs_g = {k: CSRAdj.from_sparse_tensor(v) for k, v in adjs.items()}
+    else:
+        # metapath should start with target type in label propagation
+        label_feats = {k: adjs[k].clone() for k in adjs.keys() if prop_feats or k[-1] in tgt_types}
+        adjs_g = {k: adjs[k].to(prop_device) for k in adjs.keys()}
 
+    # metapath adjs in the order the hop-by-hop expansion creates them
+    keys = [k for k in adjs_g.keys() if prop_feats or k[-1] in tgt_types]
     for hop in range(2, max_length):
         reserve_heads = [ele[-(hop+1):] for ele in extra_metapath if len(ele) > hop]
-        new_adjs = {}
-        for rtype_r, adj_r in label_feats.items():
-            metapath_types = list(rtype_r)
-            if len(metapath_types) == hop:
-                dtype_r, stype_r = metapath_types[0], metapath_types[-1]
-                for rtype_l, adj_l in adjs_g.items():
-                    dtype_l, stype_l = rtype_l
-                    if stype_l == dtype_r:
-                        name = f'{dtype_l}{rtype_r}'
-                        if (hop == num_hops and dtype_l not in tgt_types and name not in reserve_heads) \
-                          or (hop > num_hops and name not in reserve_heads):
-                            continue
-                        if name not in new_adjs:
-                            if echo: print('Generating ...', name)
-                            if prop_device == 'cpu':
-                                new_adjs[name] = adj_l.matmul(adj_r)
-                            else:
-                                with torch.no_grad():
-                                    new_adjs[name] = adj_l.matmul(adj_r.to(prop_device)).to(store_device)
-                        else:
-                            if echo: print(f'Warning: {name} already exists')
-        label_feats.update(new_adjs)
-
-        removes = []
-        for k in label_feats.keys():
-            metapath_types = list(k)
-            if metapath_types[0] in tgt_types: continue  # metapath should end with target type in label propagation
-            if len(metapath_types) <= hop:
-                removes.append(k)
-        for k in removes:
-            label_feats.pop(k)
-        if echo and len(removes): print('remove', removes)
-        del new_adjs
-        gc.collect()
+        new_keys = []
+        for rtype_r in keys:
+            if len(rtype_r) != hop:
+                continue
+            for rtype_l in adjs_g.keys():
+                dtype_l, stype_l = rtype_l
+                name = f'{dtype_l}{rtype_r}'
+                if stype_l != rtype_r[0] or name in new_keys:
+                    continue
+                if (hop == num_hops and dtype_l not in tgt_types and name not in reserve_heads) \
+                  or (hop > num_hops and name not in reserve_heads):
+                    continue
+                new_keys.append(name)
+        # metapath should end with target type in label propagation
+        keys = [k for k in keys + new_keys if k[0] in tgt_types or len(k) > hop]
+
+    prune = topk > 0 or nnz_budget > 0
+    if prune:
+        assert prop_device == 'cpu', 'pruned metapath adjs are built on cpu'
+        # row sums of the exact metapath adjs, by SpMV along the relations
+        row_mass = {}
+
+        def exact_mass(k):
+            if k not in row_mass:
+                rest = exact_mass(k[1:]) if len(k) > 2 else torch.ones(adjs_g[k].size(1), 1, dtype=torch.float64)
+                row_mass[k] = adjs_g[k[:2]].matmul(rest)
+            return row_mass[k]
+
+    estimator = ChainEstimator(adjs_g if prop_device == 'cpu' else
+                               {k: CSRAdj.from_sparse_tensor(adjs[k]) for k in adjs.keys()})
+
+    def size_of(k):
+        # estimated nnz, indptr and indices in the index dtype CSRAdj picks (int64 on gpu), float32 values
+        nnz = estimator.row_nnz(k).sum()
+        num_rows, num_cols = estimator.structure[k[:2]].shape[0], estimator.structure[k[-2:]].shape[1]
+        index_bytes = np.dtype(index_dtype(max(nnz, num_cols))).itemsize if prop_device == 'cpu' else 8
+        return (num_rows + 1 + nnz) * index_bytes + nnz * 4
+
+    steps, peak = plan_propagation(keys, size_of, base_len=2, resident=list(label_feats.keys()))
+    steps = [(op, k, 1) for op, k in steps]
+    if order == 'chain':
+        assert prop_device == 'cpu', 'chain ordered metapath adjs are built on cpu'
+        suffix_flops = sum(estimator.flops(k, split) for op, k, split in steps if op == 'build')
+        steps, chain_flops = plan_matrix_chain(keys, estimator, resident=list(label_feats.keys()))
+        print(f'Planned {sum(op == "build" for op, _, _ in steps)} products for {len(keys)} metapaths, '
+              f'estimated {chain_flops:.3g} flops ({suffix_flops:.3g} in suffix order)')
+    else:
+        print(f'Planned {sum(op == "build" for op, _, _ in steps)} products for {len(keys)} metapaths, '
+              f'estimated peak metapath adj memory {peak / 2**20:.1f} MB')
+    del estimator
+    for op, name, split in steps:
+        if op == 'free':
+            label_feats.pop(name)
+            if echo: print('remove', name)
+            continue
+        if echo: print('Generating ...', name)
+        left, right = name[:split+1], name[split:]
+        adj_l = adjs_g[left] if len(left) == 2 else label_feats[left]
+        adj_r = label_feats[right] if right in label_feats else adjs_g[right]
+        if prop_device == 'cpu' and prune:
+            label_feats[name] = spgemm(adj_l, adj_r, num_threads, topk=topk).prune(0, nnz_budget)
+            exact = exact_mass(name).sum().item()
+            kept = label_feats[name].ones_value().sum(dtype=np.float64) / exact if exact > 0 else 1.
+            print(f'{name}: keep {label_feats[name].nnz()} entries, {kept:.4f} of the exact mass')
+        elif prop_device == 'cpu':
+            label_feats[name] = spgemm(adj_l, adj_r, num_threads)
+        else:
+            with torch.no_grad():
+                label_feats[name] = adj_l.matmul(adj_r.to(prop_device)).to(store_device)
+    label_feats = {k: label_feats[k] for k in keys}
+    gc.collect()
 
     if prop_device != 'cpu':
         del adjs_g
         torch.cuda.empty_cache()
+    elif return_csr:
+        label_feats = {k: v.to_csr() if isinstance(v, RelationView) else v for k, v in label_feats.items()}
+    else:
+        for k in list(label_feats.keys()):
+            label_feats[k] = label_feats[k].to_sparse_tensor()
 
     return label_feats
 
@@ -798,91 +880,75 @@ def train_2l(model, feats, label_feats, labels_cuda, loss_fcn, optimizer, train_
     acc = evaluator(torch.cat(y_true, dim=0), torch.cat(y_pred, dim=0))
     return loss, acc
 
-def edge_mask(etypes,adjs,edge_mask_ratio):
-    from collections import Counter
-    etypes_ditc ={}
-
+def edge_mask(etypes, adjs, edge_mask_ratio):
+    '''
+    Randomly drop edges whose two endpoints both have degree > 1, the reverse relation
+    (if listed in etypes) drops the same edges. Returns new adjs in the order of etypes
+    '''
     generator = torch.Generator().manual_seed(1)
+    adjs = list(adjs)
+    etype_index = {etype: i for i, etype in zip(range(len(adjs)), etypes)}
+    visited = set()
+
+    for key, i in etype_index.items():
+        if key in visited:
+            continue
+        visited.add(key)
+        row, col, value = adjs[i].coo()
+        num_rows, num_cols = adjs[i].sparse_sizes()
+
+        droppable = (torch.bincount(row, minlength=num_rows)[row] > 1) \
+            & (torch.bincount(col, minlength=num_cols)[col] > 1)
+        drop = torch.zeros(row.shape, dtype=torch.bool)
+        drop[droppable] = torch.rand(int(droppable.sum()), generator=generator) < edge_mask_ratio
+        keep = ~drop
+
+        row, col = row[keep], col[keep]
+        value = value[keep] if value is not None else None
+        adjs[i] = SparseTensor(row=row, col=col, value=value, sparse_sizes=(num_rows, num_cols), is_sorted=True)
+
+        new_key = (key[2], key[1][::-1], key[0])
+        if new_key in etype_index and new_key not in visited:
+            visited.add(new_key)
+            j = etype_index[new_key]
+            adjs[j] = SparseTensor(row=col, col=row, value=value, sparse_sizes=adjs[j].sparse_sizes())
+    return adjs
+
+
+# node type names of the HGB datasets in data_loader type id order, the target type comes first
+NODE_TYPES = {'DBLP': 'APTV', 'IMDB': 'MDAK', 'ACM': 'PACK'}
+
+
+def attach_node_feats(g, node_feats, sparse_threshold=0):
+    '''
+    Attach raw features to g, return node types whose features are implicit one-hot vectors
+    and the features kept as CSRAdj instead: the identity of those types, never made dense,
+    and the features sparser than sparse_threshold (fraction of non-zeros)
+    '''
+    identity_types = []
+    sparse_feats = {}
+    for ntype, feat in node_feats.items():
+        if feat is None:
+            identity_types.append(ntype)
+            sparse_feats[ntype] = CSRAdj.eye(g.num_nodes(ntype))
+        elif (feat != 0).float().mean().item() < sparse_threshold:
+            sparse_feats[ntype] = CSRAdj.from_scipy(sp.csr_matrix(feat.numpy()))
+            print(f'Keep {ntype} features {tuple(feat.shape)} sparse, density {sparse_feats[ntype].density():.4f}')
+        else:
+            g.nodes[ntype].data[ntype] = feat
+    return identity_types, sparse_feats
 
-    for etype, adj in zip(etypes, adjs): 
-        etypes_ditc[etype] = [adj,False]
-
-    for key in etypes: 
-        if not etypes_ditc[key][1]:
-            etypes_ditc[key][1] = True
-            row = etypes_ditc[key][0].storage._row
-            col = etypes_ditc[key][0].storage._col
-
-            row_list,col_list = row.cpu().tolist(),col.cpu().tolist()
-            row_Counter = Counter(row_list)
-            col_Counter = Counter(col_list)
-            row_Counter = set([key for key in row_Counter.keys() if row_Counter[key] == 1])
-            col_Counter = set([key for key in col_Counter.keys() if col_Counter[key] == 1])
-
-            single_edge = torch.zeros(row.shape) == 0.0
-            for index in range(len(row_list)):
-                if row_list[index] in row_Counter or col_list[index] in col_Counter:
-                    single_edge[index] = False
-
-            edge_mask = torch.zeros(row.shape) != 0.0
-            mid_mask = torch.rand((single_edge.sum().item()), generator=generator) < edge_mask_ratio
-            edge_mask[single_edge] = mid_mask
-
-            edge_mask = ~edge_mask
-
-            row = row[edge_mask]
-            col = col[edge_mask]
-
-            etypes_ditc[key][0].storage._row,etypes_ditc[key][0].storage._col = row,col
-            new_key = (key[2],key[1][::-1],key[0])
-            if new_key in etypes_ditc and not etypes_ditc[new_key][1]:
-                etypes_ditc[new_key][1] = True
-                etypes_ditc[new_key][0].storage._row,etypes_ditc[new_key][0].storage._col = col,row
-
-
-def load_dataset(args):
-    dl = data_loader(f'{args.root}/{args.dataset}')
 
+def build_graph(args, dl, features_list):
+    '''
+    Build the relation adjs of args.dataset and run the consistency checks on them.
+    return the (src, dst) edge dict for dgl.heterograph (None for Freebase) and the adjs dict
+    '''
     edge_mask_ratio = args.edge_mask_ratio
-
-    # use one-hot index vectors for nods with no attributes
-    # === feats ===
-    features_list = []
-    for i in range(len(dl.nodes['count'])):
-        th = dl.nodes['attr'][i]
-        if th is None:
-            features_list.append(torch.eye(dl.nodes['count'][i]))
-        else:
-            features_list.append(torch.FloatTensor(th))
-
     idx_shift = np.zeros(len(dl.nodes['count'])+1, dtype=np.int32)
     for i in range(len(dl.nodes['count'])):
         idx_shift[i+1] = idx_shift[i] + dl.nodes['count'][i]
 
-    # === labels ===
-    num_classes = dl.labels_train['num_classes']
-    init_labels = np.zeros((dl.nodes['count'][0], num_classes), dtype=int)
-
-    val_ratio = 0.2
-    train_nid = np.nonzero(dl.labels_train['mask'])[0]
-    np.random.shuffle(train_nid)
-    split = int(train_nid.shape[0]*val_ratio)
-    val_nid = train_nid[:split]
-    train_nid = train_nid[split:]
-    train_nid = np.sort(train_nid)
-    val_nid = np.sort(val_nid)
-    test_nid = np.nonzero(dl.labels_test['mask'])[0]
-    test_nid_full = np.nonzero(dl.labels_test_full['mask'])[0]
-
-    init_labels[train_nid] = dl.labels_train['data'][train_nid]
-    init_labels[val_nid] = dl.labels_train['data'][val_nid]
-    init_labels[test_nid] = dl.labels_test['data'][test_nid]
-    if args.dataset != 'IMDB':
-        init_labels = init_labels.argmax(axis=1)
-
-    print(len(train_nid), len(val_nid), len(test_nid), len(test_nid_full))
-    init_labels = torch.LongTensor(init_labels)
-
     # === adjs ===
     # print(dl.nodes['attr'])
     # for k, v in dl.nodes['attr'].items():
@@ -914,7 +980,6 @@ def load_dataset(args):
         # paper : [14328, 4231]
         # term  : [7723, 50]
         # venue(conference) : None
-        A, P, T, V = features_list
         AP, PA, PT, PV, TP, VP = adjs
 
         new_edges = {}
@@ -928,32 +993,17 @@ def load_dataset(args):
             ('P', 'P-V', 'V'),
         ]
         if edge_mask_ratio != 0:
-            edge_mask(etypes,adjs,edge_mask_ratio)
+            adjs = edge_mask(etypes, adjs, edge_mask_ratio)
+            AP, PA, PT, PV, TP, VP = adjs
 
-
-                    
-        
-        
         for etype, adj in zip(etypes, adjs):
             stype, rtype, dtype = etype
             dst, src, _ = adj.coo()
-            src = src.numpy()
-            dst = dst.numpy()
+            src = src.numpy().astype(np.int32)
+            dst = dst.numpy().astype(np.int32)
             new_edges[(stype, rtype, dtype)] = (src, dst)
             ntypes.add(stype)
             ntypes.add(dtype)
-        g = dgl.heterograph(new_edges)
-
-        # for i, etype in enumerate(g.etypes):
-        #     src, dst, eid = g._graph.edges(i)
-        #     adj = SparseTensor(row=dst.long(), col=src.long())
-        #     print(etype, adj)
-
-        # g.ndata['feat']['A'] = A # not work
-        g.nodes['A'].data['A'] = A
-        g.nodes['P'].data['P'] = P
-        g.nodes['T'].data['T'] = T
-        g.nodes['V'].data['V'] = V
     elif args.dataset == 'IMDB':
         # A --- M* --- D
         #       |
@@ -962,7 +1012,6 @@ def load_dataset(args):
         # director : [2393, 3341]
         # actor    : [6124, 3341]
         # keywords : None
-        M, D, A, K = features_list
         MD, DM, MA, AM, MK, KM = adjs
         assert torch.all(DM.storage.col() == MD.t().storage.col())
         assert torch.all(AM.storage.col() == MA.t().storage.col())
@@ -981,22 +1030,16 @@ def load_dataset(args):
             ('M', 'M-K', 'K'),
         ]
         if edge_mask_ratio != 0:
-            edge_mask(etypes,adjs,edge_mask_ratio)
+            adjs = edge_mask(etypes, adjs, edge_mask_ratio)
+            MD, DM, MA, AM, MK, KM = adjs
         for etype, adj in zip(etypes, adjs):
             stype, rtype, dtype = etype
             dst, src, _ = adj.coo()
-            src = src.numpy()
-            dst = dst.numpy()
+            src = src.numpy().astype(np.int32)
+            dst = dst.numpy().astype(np.int32)
             new_edges[(stype, rtype, dtype)] = (src, dst)
             ntypes.add(stype)
             ntypes.add(dtype)
-        g = dgl.heterograph(new_edges)
-
-        g.nodes['M'].data['M'] = M
-        g.nodes['D'].data['D'] = D
-        g.nodes['A'].data['A'] = A
-        if args.num_hops > 2 :#or args.two_layer:
-            g.nodes['K'].data['K'] = K
     elif args.dataset == 'ACM':
         # A --- P* --- C
         #       |
@@ -1005,12 +1048,15 @@ def load_dataset(args):
         # author    : [5959, 1902]
         # conference: [56, 1902]
         # field     : None
-        P, A, C, K = features_list
+        P, A, C, _ = features_list
         PP, PP_r, PA, AP, PC, CP, PK, KP = adjs
         row, col = torch.where(P)
         assert torch.all(row == PK.storage.row()) and torch.all(col == PK.storage.col())
-        assert torch.all(AP.matmul(PK).to_dense() == A)
-        assert torch.all(CP.matmul(PK).to_dense() == C)
+        # A and C are None when a pruned schema does not need their features
+        if A is not None:
+            assert torch.all(AP.matmul(PK).to_dense() == A)
+        if C is not None:
+            assert torch.all(CP.matmul(PK).to_dense() == C)
 
         assert torch.all(PA.storage.col() == AP.t().storage.col())
         assert torch.all(PC.storage.col() == CP.t().storage.col())
@@ -1034,7 +1080,8 @@ def load_dataset(args):
         ]
 
         if edge_mask_ratio != 0:
-            edge_mask(etypes,adjs,edge_mask_ratio)
+            adjs = edge_mask(etypes, adjs, edge_mask_ratio)
+            PP, PA, AP, PC, CP, PK, KP = adjs
         if args.ACM_keep_F:
             etypes += [
                 ('K', 'K-P', 'P'),
@@ -1043,19 +1090,11 @@ def load_dataset(args):
         for etype, adj in zip(etypes, adjs):
             stype, rtype, dtype = etype
             dst, src, _ = adj.coo()
-            src = src.numpy()
-            dst = dst.numpy()
+            src = src.numpy().astype(np.int32)
+            dst = dst.numpy().astype(np.int32)
             new_edges[(stype, rtype, dtype)] = (src, dst)
             ntypes.add(stype)
             ntypes.add(dtype)
-
-        g = dgl.heterograph(new_edges)
-
-        g.nodes['P'].data['P'] = P # [3025, 1902]
-        g.nodes['A'].data['A'] = A # [5959, 1902]
-        g.nodes['C'].data['C'] = C # [56, 1902]
-        if args.ACM_keep_F:
-            g.nodes['K'].data['K'] = K # [1902, 1902]
     elif args.dataset == 'Freebase':
         # 0*: 40402  2/4/7 <-- 0 <-- 0/1/3/5/6
         #  1: 19427  all <-- 1
@@ -1079,7 +1118,7 @@ def load_dataset(args):
                         print(k, v.sizes(), v.nnz())
 
         adjs['00'] = adjs['00'].to_symmetric()
-        g = None
+        new_edges = None
     else:
         assert 0
 
@@ -1101,7 +1140,225 @@ def load_dataset(args):
     else:
         assert 0
 
-    return g, adjs, init_labels, num_classes, dl, train_nid, val_nid, test_nid, test_nid_full
+    return new_edges, adjs
+
+
+def load_graph(args, dl, features_list):
+    '''
+    build_graph with a validated-graph cache next to the dataset, keyed by the source files and the
+    settings that change the graph, so the checks (dense ones for ACM) only run the first time.
+    A pruned schema skips the checks of the features it drops, so its graph is cached apart
+    '''
+    key = ';'.join([dl.cache_key, args.dataset, f'edge_mask_ratio={args.edge_mask_ratio}', f'ACM_keep_F={args.ACM_keep_F}'])
+    if dl.attr_types is not None:
+        key += f';attr_types={sorted(dl.attr_types)}'
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    cache_file = os.path.join(dl.path, f'graph_cache_{digest}.pt')
+
+    if not args.no_graph_cache and os.path.exists(cache_file):
+        try:
+            cache = torch.load(cache_file)
+        except Exception:
+            cache = None
+        if cache is not None and cache['key'] == key:
+            new_edges = None
+            if cache['edges'] is not None:
+                new_edges = {etype: (src.numpy(), dst.numpy()) for etype, (src, dst) in cache['edges'].items()}
+            adjs = {k: SparseTensor(row=row, col=col, value=value, sparse_sizes=tuple(sizes), is_sorted=True)
+                for k, (row, col, value, sizes) in cache['adjs'].items()}
+            print(f'Load validated graph from {cache_file}')
+            return new_edges, adjs
+
+    new_edges, adjs = build_graph(args, dl, features_list)
+    if not args.no_graph_cache:
+        cache = {'key': key, 'edges': None, 'adjs': {}}
+        if new_edges is not None:
+            cache['edges'] = {etype: (torch.from_numpy(src), torch.from_numpy(dst)) for etype, (src, dst) in new_edges.items()}
+        for k, adj in adjs.items():
+            row, col, value = adj.coo()
+            cache['adjs'][k] = (row, col, value, list(adj.sparse_sizes()))
+        try:
+            torch.save(cache, cache_file + '.tmp')
+            os.replace(cache_file + '.tmp', cache_file)
+        except OSError as e:
+            print(f'Warning: cannot write graph cache {cache_file}: {e}')
+    return new_edges, adjs
+
+
+def metapath_keys(g, tgt_type, num_hops, src_types):
+    '''
+    Keys hg_propagate_feat_dgl produces at tgt_type, in the order the
+    hop-by-hop propagation creates them: every metapath of at most num_hops relations of g
+    that starts from one of src_types
+    '''
+    keys = {ntype: [ntype] if ntype in src_types else [] for ntype in g.ntypes}
+    for hop in range(1, num_hops + 1):
+        for stype, _, dtype in g.canonical_etypes:
+            for k in list(keys[stype]):
+                if len(k) == hop and (hop < num_hops or dtype == tgt_type):
+                    keys[dtype].append(f'{dtype}{k}')
+        for ntype in g.ntypes:
+            if ntype != tgt_type:
+                keys[ntype] = [k for k in keys[ntype] if len(k) > hop]
+    return list(dict.fromkeys(keys[tgt_type]))
+
+
+def prop_cache_dir(args, dl):
+    '''
+    Propagated-feature cache for one dataset and graph setting, with a file per metapath.
+    A metapath's features do not depend on num_hops, so a run with fewer hops (or a subset of
+    metapaths) is served by the files of a larger run
+    '''
+    key = ';'.join([dl.cache_key, args.dataset, f'edge_mask_ratio={args.edge_mask_ratio}', f'ACM_keep_F={args.ACM_keep_F}'])
+    # same values, but which keys are stored sparse depends on the thresholds
+    if args.sparse_feat_threshold > 0:
+        key += f';sparse_feat_threshold={args.sparse_feat_threshold}'
+    key += f';sparse_fill_threshold={args.sparse_fill_threshold}'
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(args.prop_cache_dir or dl.path, f'prop_cache_{digest}'), key
+
+
+def load_prop_cache(cache_dir, key, keys):
+    '''
+    Cached features of keys, in the order of keys (see metapath_keys). None if any of them is missing
+    '''
+    try:
+        with open(os.path.join(cache_dir, 'index.json')) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index['key'] != key or not all(k in index['keys'] for k in keys):
+        return None
+    feats = {}
+    for k in keys:
+        v = torch.load(os.path.join(cache_dir, f'{k}.pt'))
+        if isinstance(v, tuple):
+            row, col, value, sizes = v
+            v = SparseTensor(row=row, col=col, value=value, sparse_sizes=tuple(sizes), is_sorted=True)
+        feats[k] = v
+    return feats
+
+
+def save_prop_cache(cache_dir, key, feats):
+    '''
+    Add the features not cached yet, the index is rewritten after their files
+    '''
+    index = {'key': key, 'keys': []}
+    if os.path.exists(os.path.join(cache_dir, 'index.json')):
+        with open(os.path.join(cache_dir, 'index.json')) as f:
+            index = json.load(f)
+        if index['key'] != key:
+            index = {'key': key, 'keys': []}
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for k, v in feats.items():
+            if k in index['keys']:
+                continue
+            if isinstance(v, SparseTensor):
+                row, col, value = v.coo()
+                v = (row, col, value, list(v.sparse_sizes()))
+            torch.save(v, os.path.join(cache_dir, f'{k}.pt'))
+            index['keys'].append(k)
+        with open(os.path.join(cache_dir, 'index.json.tmp'), 'w') as f:
+            json.dump(index, f)
+        os.replace(os.path.join(cache_dir, 'index.json.tmp'), os.path.join(cache_dir, 'index.json'))
+        print(f'Save propagated features to {cache_dir}')
+    except OSError as e:
+        print(f'Warning: cannot write propagated feature cache {cache_dir}: {e}')
+
+
+def get_schema(args, feat_paths=None, label_paths=None):
+    '''
+    Relations (keys like 'AP', dst then src) and node types whose features are needed, None to load everything.
+    They come from the given metapaths (e.g. an arch of arch.py), otherwise from the type alphabet --schema_types
+    '''
+    if feat_paths is not None:
+        relations, feat_types = set(), {NODE_TYPES.get(args.dataset, '0')[0]}
+        for path in list(feat_paths) + list(label_paths or []):
+            relations.update(path[i:i+2] for i in range(len(path) - 1))
+        feat_types.update(path[-1] for path in feat_paths)
+        return relations, feat_types
+    if len(args.schema_types):
+        return {a + b for a in args.schema_types for b in args.schema_types}, set(args.schema_types)
+    return None
+
+
+def load_dataset(args, feat_paths=None, label_paths=None):
+    '''
+    feat_paths/label_paths: only load the relations and attribute matrices these metapaths reach
+    '''
+    schema = get_schema(args, feat_paths, label_paths)
+    attr_types = None
+    if schema is not None and args.dataset in NODE_TYPES:
+        attr_types = [i for i, ntype in enumerate(NODE_TYPES[args.dataset]) if ntype in schema[1]]
+    dl = data_loader(f'{args.root}/{args.dataset}', attr_types=attr_types)
+
+    # use one-hot index vectors for nods with no attributes
+    # === feats ===
+    features_list = []
+    for i in range(len(dl.nodes['count'])):
+        th = dl.nodes['attr'][i]
+        if th is None:
+            # one-hot features are kept implicit, see attach_node_feats
+            features_list.append(None)
+        else:
+            features_list.append(torch.FloatTensor(th))
+
+    # === labels ===
+    num_classes = dl.labels_train['num_classes']
+    init_labels = np.zeros((dl.nodes['count'][0], num_classes), dtype=int)
+
+    val_ratio = 0.2
+    train_nid = dl.labels_train['nodes'].copy()
+    np.random.shuffle(train_nid)
+    split = int(train_nid.shape[0]*val_ratio)
+    val_nid = train_nid[:split]
+    train_nid = train_nid[split:]
+    train_nid = np.sort(train_nid)
+    val_nid = np.sort(val_nid)
+    test_nid = dl.labels_test['nodes'].copy()
+    test_nid_full = dl.labels_test_full['nodes'].copy()
+
+    init_labels[train_nid] = dl.get_label_matrix(dl.labels_train, train_nid)
+    init_labels[val_nid] = dl.get_label_matrix(dl.labels_train, val_nid)
+    init_labels[test_nid] = dl.get_label_matrix(dl.labels_test, test_nid)
+    if args.dataset != 'IMDB':
+        init_labels = init_labels.argmax(axis=1)
+
+    print(len(train_nid), len(val_nid), len(test_nid), len(test_nid_full))
+    init_labels = torch.LongTensor(init_labels)
+
+    new_edges, adjs = load_graph(args, dl, features_list)
+    if schema is not None:
+        if new_edges is not None:
+            new_edges = {etype: v for etype, v in new_edges.items() if f'{etype[2]}{etype[0]}' in schema[0]}
+        adjs = {k: v for k, v in adjs.items() if k in schema[0]}
+        print(f'Pruned schema: relations {sorted(adjs.keys())}, feature types {sorted(schema[1])}')
+    # one copy per edge set, both directions row-normalized on the fly
+    adjs = RelationStore.from_adjs(adjs)
+    g = dgl.heterograph(new_edges, idtype=torch.int32) if new_edges is not None else None
+
+    if args.dataset == 'DBLP':
+        # g.ndata['feat']['A'] = A # not work
+        A, P, T, V = features_list
+        node_feats = {'A': A, 'P': P, 'T': T, 'V': V}
+    elif args.dataset == 'IMDB':
+        M, D, A, K = features_list
+        node_feats = {'M': M, 'D': D, 'A': A}
+        if args.num_hops > 2 :#or args.two_layer:
+            node_feats['K'] = K
+    elif args.dataset == 'ACM':
+        P, A, C, K = features_list
+        node_feats = {'P': P, 'A': A, 'C': C} # [3025, 1902], [5959, 1902], [56, 1902]
+        if args.ACM_keep_F:
+            node_feats['K'] = K # implicit [1902, 1902]
+    else:
+        node_feats = {}
+    if schema is not None:
+        node_feats = {k: v for k, v in node_feats.items() if k in schema[1] and k in g.ntypes}
+    identity_types, sparse_feats = attach_node_feats(g, node_feats, args.sparse_feat_threshold)
+
+    return g, adjs, init_labels, num_classes, dl, train_nid, val_nid, test_nid, test_nid_full, identity_types, sparse_feats
 
 
 class EarlyStopping:
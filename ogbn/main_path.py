@@ -16,7 +16,7 @@ from arch import archs
 def main(args):
     if args.seed > 0:
         set_random_seed(args.seed)
-    g, init_labels, num_nodes, n_classes, train_nid, val_nid, test_nid, evaluator = load_dataset(args)
+    g, init_labels, num_nodes, n_classes, train_nid, val_nid, test_nid, evaluator = load_dataset(args, *archs[args.arch])
     device = "cuda:{}".format(args.gpu) if not args.cpu else 'cpu'
 
     if args.label_feats and args.num_label_hops >= 3:
@@ -99,20 +99,45 @@ def main(args):
         else:
             max_hops = args.num_hops + 1
 
-        # compute k-hop feature
-        g = hg_propagate(g, tgt_type, args.num_hops, max_hops, extra_metapath, echo=False)
+        # propagation does not depend on the seed (unless embeddings are random), so it is cached across runs
+        src_types = [ntype for ntype in g.ntypes if ntype in g.nodes[ntype].data]
+        cache_dir, cache_key = prop_cache_dir(args, src_types)
+        use_cache = not args.no_prop_cache and cache_dir is not None
+        keys = [k for k in metapath_keys(g, tgt_type, args.num_hops, src_types) if k in archs[args.arch][0] or k == tgt_type]
+        feats = None
+        if use_cache:
+            feats = load_prop_cache(cache_dir, cache_key, keys, mmap=spill_propagation(args))
+        if feats is not None:
+            print(f'Load cached feat keys {list(feats.keys())} from {cache_dir}')
+        else:
+            # compute k-hop feature
+            # only the metapaths of the arch (and their suffixes on the way)
+            feats = {}
+            if args.prop_mem_budget > 0:
+                spill_dir = args.spill_dir or get_snapshot_dir(args)
+                feats = hg_propagate_spill(g, tgt_type, args.num_hops, max_hops, extra_metapath,
+                                           int(args.prop_mem_budget * 2**30), spill_dir, half=args.spill_half, row_index=init2sort,
+                                           meta_path=archs[args.arch][0])
+            elif args.prop_threads > 0:
+                feats = hg_propagate_chunked(g, tgt_type, args.num_hops, max_hops, extra_metapath, args.prop_threads,
+                                             args.prop_chunk_cols, int(args.prop_chunk_mb * 2**20),
+                                             meta_path=archs[args.arch][0])
+            else:
+                g = hg_propagate(g, tgt_type, args.num_hops, max_hops, extra_metapath, echo=False, meta_path=archs[args.arch][0], backend=args.prop_backend)
 
-        feats = {}
-        keys = list(g.nodes[tgt_type].data.keys())
-        print(f'Involved feat keys {keys}')
-        for k in keys:
-            feats[k] = g.nodes[tgt_type].data.pop(k)
+            keys = list(g.nodes[tgt_type].data.keys())
+            for k in keys:
+                feats[k] = g.nodes[tgt_type].data.pop(k)
+            print(f'Involved feat keys {list(feats.keys())}')
+            if use_cache:
+                save_prop_cache(cache_dir, cache_key, feats)
 
         g = clear_hg(g, echo=False)
     else:
         assert 0
 
-    feats = {k: v[init2sort] for k, v in feats.items()}
+    if not spill_propagation(args):
+        feats = {k: v[init2sort] for k, v in feats.items()}
 
     feats = {k: v for k, v in feats.items() if k in archs[args.arch][0] or k == tgt_type}
 
@@ -272,7 +297,7 @@ def main(args):
                 else:
                     max_hops = args.num_label_hops + 1
 
-                g = hg_propagate(g, tgt_type, args.num_label_hops, max_hops, extra_metapath, echo=False)
+                g = hg_propagate(g, tgt_type, args.num_label_hops, max_hops, extra_metapath, echo=False, backend=args.prop_backend)
 
                 keys = list(g.nodes[tgt_type].data.keys())
                 print(f'Involved label keys {keys}')
@@ -394,7 +419,7 @@ def main(args):
 
                     start = time.time()
                     for batch_feats, batch_label_feats, batch_labels_emb in eval_loader:
-                        batch_feats = {k: v.to(device) for k,v in batch_feats.items()}
+                        batch_feats = {k: v.to(device).float() for k,v in batch_feats.items()}
                         batch_label_feats = {k: v.to(device) for k,v in batch_label_feats.items()}
                         batch_labels_emb = batch_labels_emb.to(device)
                         raw_preds.append(model(batch_feats, batch_label_feats, batch_labels_emb).cpu())
@@ -445,6 +470,28 @@ def parse_args(args=None):
     parser.add_argument("--gpu", type=int, default=0)
     parser.add_argument("--cpu", action='store_true', default=False)
     parser.add_argument("--root", type=str, default='../data/')
+    parser.add_argument("--snapshot_dir", type=str, default='',
+                        help="local binary snapshot of the dataset, built on first use (default: <root>/<dataset>_snapshot)")
+    parser.add_argument("--schema_types", type=str, default='',
+                        help="only load relations and features among these node types, e.g. PAF (empty for all)")
+    parser.add_argument("--no-prop-cache", action='store_true', default=False,
+                        help="always propagate features instead of reusing the propagated feature cache")
+    parser.add_argument("--prop_cache_dir", type=str, default='',
+                        help="where to keep propagated features (default: the snapshot directory)")
+    parser.add_argument("--prop_mem_budget", type=float, default=0,
+                        help="RAM budget in GB for feature propagation, features beyond it are spilled to disk (0 to keep all in memory)")
+    parser.add_argument("--spill_dir", type=str, default='',
+                        help="where to spill features under --prop_mem_budget (default: the snapshot directory)")
+    parser.add_argument("--spill_half", action='store_true', default=False,
+                        help="store propagated features in float16 under --prop_mem_budget")
+    parser.add_argument("--prop_threads", type=int, default=0,
+                        help="propagate feature column chunks on this many CPU threads (0 to use DGL update_all)")
+    parser.add_argument("--prop_chunk_cols", type=int, default=0,
+                        help="feature columns per chunk with --prop_threads (0 to size chunks by --prop_chunk_mb)")
+    parser.add_argument("--prop_chunk_mb", type=float, default=256,
+                        help="planned peak memory in MB of the chunks propagated at once with --prop_threads")
+    parser.add_argument("--prop-backend", type=str, default='dgl', choices=['dgl', 'csr'],
+                        help="feature propagation with DGL update_all, or with row-normalized CSR operators built once per relation")
     parser.add_argument("--stages", nargs='+',type=int, default=[200, 200, 200, 200, 200, 200],
                         help="The epoch setting for each stage.")
     ## For pre-processing
@@ -504,6 +551,12 @@ def parse_args(args=None):
     parser.add_argument("--max_mask_deg", type=int, default=None)
     parser.add_argument("--in_max_deg", type=int, default=None)
     parser.add_argument("--out_max_deg", type=int, default=None)
+    parser.add_argument("--rel_in_max_deg", type=str, nargs='*', default=[],
+                        help="per-relation in-degree caps as etype=k, e.g. cites=10")
+    parser.add_argument("--rel_out_max_deg", type=str, nargs='*', default=[],
+                        help="per-relation out-degree caps as etype=k, e.g. writes=5")
+    parser.add_argument("--random_deg_limit", action='store_true', default=False,
+                        help="keep a random subset (seeded by --mask_seed) instead of the first edges when capping degrees")
 
     return parser.parse_args(args)
 
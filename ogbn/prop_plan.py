@@ -0,0 +1,73 @@
+'''
+Shared-suffix scheduling of metapath propagation.
+
+A metapath key grows by its first (dst) type at every hop, so key k is built from its suffix k[1:]
+through the relation k[:2]. The keys needed by a set of target metapaths form a forest of suffix
+trees rooted at the keys of length base_len (raw features, or relations for adjacency products).
+The plan walks it depth-first and frees every intermediate right after its last child is built,
+instead of holding whole hop levels at once.
+
+hgb/ and ogbn/ each run from their own directory, so both keep this file; keep the two copies identical.
+'''
+
+
+def suffix_tree(targets, base_len=1):
+    '''
+    children of every needed key and the roots (keys of length base_len), in the order of targets
+    '''
+    needed = {}
+    for path in targets:
+        for i in range(len(path) - base_len, -1, -1):
+            needed[path[i:]] = None
+    children = {k: [] for k in needed}
+    for k in needed:
+        if len(k) > base_len:
+            children[k[1:]].append(k)
+    roots = [k for k in needed if len(k) == base_len]
+    return children, roots
+
+
+def plan_propagation(targets, size_of=None, base_len=1, resident=()):
+    '''
+    Order the builds of targets and of the suffixes they need.
+    Targets are never freed, any other key is freed right after its last child is built.
+    Siblings are expanded by increasing subtree size, the largest one last, when their parent is already freed.
+    resident are keys live before the first step (e.g. raw features), the ones no target needs are freed first.
+
+    return the steps [('build', key) or ('free', key)] and the planned peak, the largest sum of size_of over live keys
+    '''
+    size_of = size_of or (lambda k: 1)
+    targets = list(dict.fromkeys(targets))
+    keep = set(targets)
+    children, roots = suffix_tree(targets, base_len)
+
+    weight = {}
+    for k in sorted(children, key=len, reverse=True):
+        weight[k] = size_of(k) + sum(weight[c] for c in children[k])
+
+    steps = [('free', k) for k in resident if k not in children]
+
+    def visit(k):
+        kids = sorted(children[k], key=lambda c: weight[c])
+        for i, c in enumerate(kids):
+            steps.append(('build', c))
+            if i == len(kids) - 1 and k not in keep:
+                steps.append(('free', k))
+            visit(c)
+
+    for k in roots:
+        if k not in resident:
+            steps.append(('build', k))
+        visit(k)
+
+    live = set(resident)
+    current = peak = sum(size_of(k) for k in live)
+    for op, k in steps:
+        if op == 'build':
+            live.add(k)
+            current += size_of(k)
+            peak = max(peak, current)
+        else:
+            live.discard(k)
+            current -= size_of(k)
+    return steps, peak
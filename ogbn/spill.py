@@ -0,0 +1,109 @@
+import os
+import uuid
+import numpy as np
+import scipy.sparse as sp
+import torch
+
+
+class SpillStore:
+    '''
+    Metapath features kept in RAM while they fit in budget bytes, written to column-major .npy
+    memory maps under path otherwise, so a column chunk of a spilled feature is one contiguous read.
+    Files are unlinked by close(), arrays still mapped stay readable until they are dropped
+    '''
+    def __init__(self, path, budget, dtype=np.float32):
+        self.path = os.path.join(path, f'spill_{uuid.uuid4().hex[:8]}')
+        self.budget = budget
+        self.dtype = np.dtype(dtype)
+        self.arrays = {}
+        self.files = {}
+        self.resident_bytes = 0
+        os.makedirs(self.path)
+
+    def nbytes(self, shape):
+        return int(shape[0]) * int(shape[1]) * self.dtype.itemsize
+
+    def create(self, key, shape):
+        '''
+        Empty array for key, in RAM if it fits in the budget and memory-mapped otherwise
+        '''
+        size = self.nbytes(shape)
+        if self.resident_bytes + size <= self.budget:
+            self.arrays[key] = np.empty(shape, dtype=self.dtype)
+            self.resident_bytes += size
+        else:
+            self.files[key] = os.path.join(self.path, f'{key}.npy')
+            self.arrays[key] = np.lib.format.open_memmap(
+                self.files[key], mode='w+', dtype=self.dtype, shape=tuple(shape), fortran_order=True)
+        return self.arrays[key]
+
+    def put(self, key, value, chunk_cols):
+        value = value.numpy() if isinstance(value, torch.Tensor) else value
+        out = self.create(key, value.shape)
+        for beg in range(0, value.shape[1], chunk_cols):
+            out[:, beg:beg+chunk_cols] = value[:, beg:beg+chunk_cols]
+        return out
+
+    def take_rows(self, key, index, chunk_cols):
+        '''
+        Replace key by its rows index (e.g. a reordering of the nodes), one column chunk at a time.
+        The result is row-major, so a batch of rows is read from contiguous ranges
+        '''
+        x = self.arrays[key]
+        index = np.asarray(index)
+        shape = (len(index), x.shape[1])
+        if key in self.files:
+            path = os.path.join(self.path, f'{key}_rows.npy')
+            out = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=shape)
+        else:
+            out = np.empty(shape, dtype=self.dtype)
+        for beg in range(0, x.shape[1], chunk_cols):
+            out[:, beg:beg+chunk_cols] = x[:, beg:beg+chunk_cols][index]
+        self.free(key)
+        if isinstance(out, np.memmap):
+            self.files[key] = path
+        else:
+            self.resident_bytes += self.nbytes(shape)
+        self.arrays[key] = out
+        return out
+
+    def get(self, key):
+        return self.arrays[key]
+
+    def is_spilled(self, key):
+        return key in self.files
+
+    def free(self, key):
+        value = self.arrays.pop(key)
+        if key in self.files:
+            os.remove(self.files.pop(key))
+        else:
+            self.resident_bytes -= self.nbytes(value.shape)
+
+    def close(self):
+        for key in list(self.files.keys()):
+            os.remove(self.files.pop(key))
+        os.rmdir(self.path)
+
+
+def mean_adj(src, dst, num_src, num_dst):
+    '''
+    Row-normalized [num_dst, num_src] adjacency, A @ x is the mean of x over in-edges (fn.mean)
+    as a torch CSR tensor, the ogbn side of hgb's CSRAdj.row_mean
+    '''
+    adj = sp.csr_matrix((np.ones(len(src), dtype=np.float32), (dst, src)), shape=(num_dst, num_src))
+    deg = np.asarray(adj.sum(1)).reshape(-1)
+    adj = sp.diags(1 / np.maximum(deg, 1).astype(np.float32)) @ adj
+    adj = adj.tocsr()
+    adj.sort_indices()
+    return torch.sparse_csr_tensor(torch.from_numpy(adj.indptr), torch.from_numpy(adj.indices),
+                                   torch.from_numpy(adj.data.astype(np.float32)), size=adj.shape)
+
+
+def spmm_chunked(adj, x, out, chunk_cols):
+    '''
+    out = adj @ x one column chunk at a time, in float32 whatever the storage dtype
+    '''
+    for beg in range(0, x.shape[1], chunk_cols):
+        x_chunk = torch.from_numpy(np.ascontiguousarray(x[:, beg:beg+chunk_cols], dtype=np.float32))
+        out[:, beg:beg+chunk_cols] = (adj @ x_chunk).numpy()
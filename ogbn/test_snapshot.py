@@ -0,0 +1,86 @@
+'''
+Round trip of a small synthetic ogbn-mag through write_mag_snapshot and load_mag, run with
+    python -m pytest test_snapshot.py
+from this directory
+'''
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('dgl')
+pytest.importorskip('torch_sparse')
+pytest.importorskip('ogb')
+pytest.importorskip('sparse_tools')
+
+from utils import write_mag_snapshot, load_mag_snapshot, snapshot_edges, load_mag
+from train_search import parse_args
+
+
+CANONICAL_ETYPES = [('author', 'affiliated_with', 'institution'), ('author', 'writes', 'paper'),
+                    ('paper', 'cites', 'paper'), ('paper', 'has_topic', 'field_of_study')]
+
+
+def synthetic_mag(seed=0):
+    rng = np.random.default_rng(seed)
+    num_nodes = {'author': 40, 'institution': 6, 'paper': 50, 'field_of_study': 12}
+    edges = {}
+    for stype, etype, dtype in CANONICAL_ETYPES:
+        src = rng.integers(0, num_nodes[stype], 120)
+        dst = rng.integers(0, num_nodes[dtype], 120)
+        if stype == dtype:
+            # load_mag expects no self citation
+            src, dst = src[src != dst], dst[src != dst]
+        # keep the largest node ids so sizes inferred from the CSR match num_nodes
+        src[0], dst[0] = num_nodes[stype] - 1, num_nodes[dtype] - 2
+        src[1], dst[1] = num_nodes[stype] - 2, num_nodes[dtype] - 1
+        edges[etype] = (src, dst)
+    paper_feat = rng.standard_normal((num_nodes['paper'], 8)).astype(np.float32)
+    labels = rng.integers(0, 5, num_nodes['paper'])
+    labels[0] = 4
+    perm = rng.permutation(num_nodes['paper'])
+    splits = {'train': perm[:30], 'valid': perm[30:40], 'test': perm[40:]}
+    return num_nodes, edges, paper_feat, labels, splits
+
+
+def test_snapshot_round_trip(tmp_path, monkeypatch):
+    num_nodes, edges, paper_feat, labels, splits = synthetic_mag()
+    snapshot_dir = tmp_path / 'snapshot'
+    write_mag_snapshot(str(snapshot_dir), num_nodes, CANONICAL_ETYPES, edges, paper_feat, labels, splits)
+
+    snapshot = load_mag_snapshot(str(snapshot_dir))
+    assert snapshot['num_nodes'] == num_nodes
+    assert snapshot['canonical_etypes'] == CANONICAL_ETYPES
+    for _, etype, _ in CANONICAL_ETYPES:
+        indptr, indices, eid = snapshot['csr'][etype]
+        src, dst = snapshot_edges(snapshot['csr'][etype])
+        # edges come back in their original (edge id) order
+        assert np.array_equal(src.numpy(), edges[etype][0])
+        assert np.array_equal(dst.numpy(), edges[etype][1])
+        assert np.array_equal(np.sort(eid), np.arange(len(edges[etype][0])))
+        assert np.array_equal(indices, edges[etype][0][eid])
+    assert torch.equal(snapshot['paper_feat'], torch.from_numpy(paper_feat))
+    # paper features are a copy-on-write map of the file: writes stay in memory
+    snapshot['paper_feat'][0] = 0
+    assert np.array_equal(np.load(snapshot_dir / 'paper_feat.npy', mmap_mode='r'), paper_feat)
+    assert torch.equal(snapshot['labels'], torch.from_numpy(labels))
+    for name, nid in splits.items():
+        assert torch.equal(snapshot[f'{name}_nid'], torch.from_numpy(nid))
+
+    # load_mag writes its diag files to the working directory
+    monkeypatch.chdir(tmp_path)
+    args = parse_args(['--snapshot_dir', str(snapshot_dir), '--embed-size', '4'])
+    g, init_labels, num_nodes_p, n_classes, train_nid, val_nid, test_nid, _ = load_mag(args)
+    assert num_nodes_p == num_nodes['paper'] and n_classes == 5
+    assert torch.equal(init_labels, torch.from_numpy(labels))
+    assert torch.equal(train_nid, torch.from_numpy(splits['train']))
+    assert torch.equal(g.nodes['P'].data['P'], torch.from_numpy(paper_feat))
+
+    def edge_set(src, dst):
+        return set(zip(np.asarray(src).tolist(), np.asarray(dst).tolist()))
+
+    src, dst = edges['writes']
+    assert edge_set(*g.edges(etype='A-P')) == edge_set(src, dst)
+    assert edge_set(*g.edges(etype='P-A')) == edge_set(dst, src)
+    src, dst = edges['cites']
+    # citations are made symmetric
+    assert edge_set(*g.edges(etype='P-P')) == edge_set(src, dst) | edge_set(dst, src)
@@ -1,5 +1,7 @@
 import os
 import gc
+import json
+import hashlib
 import random
 import dgl
 import dgl.function as fn
@@ -10,9 +12,13 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from tqdm import tqdm
 from torch_sparse import SparseTensor
 from ogb.nodeproppred import DglNodePropPredDataset, Evaluator
+from prop_plan import plan_propagation
+from spill import SpillStore, mean_adj, spmm_chunked
 
 
 
@@ -82,93 +88,226 @@ def get_n_params(model):
     return pp
 
 
-def hg_propagate(new_g, tgt_type, num_hops, max_hops, extra_metapath, echo=False):
-    for hop in range(1, max_hops):
-        reserve_heads = [ele[:hop] for ele in extra_metapath if len(ele) > hop]
-        for etype in new_g.etypes:
-            stype, _, dtype = new_g.to_canonical_etype(etype)
-
-            for k in list(new_g.nodes[stype].data.keys()):
-                if len(k) == hop:
-                    current_dst_name = f'{dtype}{k}'
-                    if (hop == num_hops and dtype != tgt_type and k not in reserve_heads) \
-                      or (hop > num_hops and k not in reserve_heads):
-                        continue
-                    if echo: print(k, etype, current_dst_name)
-                    new_g[etype].update_all(
-                        fn.copy_u(k, 'm'),
-                        fn.mean('m', current_dst_name), etype=etype)
-
-        # remove no-use items
-        for ntype in new_g.ntypes:
-            if ntype == tgt_type: continue
-            removes = []
-            for k in new_g.nodes[ntype].data.keys():
-                if len(k) <= hop:
-                    removes.append(k)
-            for k in removes:
-                new_g.nodes[ntype].data.pop(k)
-            if echo and len(removes): print('remove', removes)
-        gc.collect()
-
-        if echo: print(f'-- hop={hop} ---')
-        for ntype in new_g.ntypes:
-            for k, v in new_g.nodes[ntype].data.items():
-                if echo: print(f'{ntype} {k} {v.shape}')
-        if echo: print(f'------\n')
+def hg_propagate_planned(new_g, tgt_type, targets, echo=False, backend='dgl'):
+    '''
+    Build the metapath features targets (keys like 'PAP', see metapath_keys) at tgt_type,
+    in the order of plan_propagation so every intermediate is dropped right after its last use.
+    backend 'dgl' runs update_all on the node frames, 'csr' multiplies row-normalized operators
+    built once per relation (see mean_adj) and keeps the features out of DGL.
+    Raw features no target needs are dropped too, the targets are left at tgt_type in the order given
+    '''
+    assert backend in ['dgl', 'csr'], backend
+    src_types = [ntype for ntype in new_g.ntypes if ntype in new_g.nodes[ntype].data]
+    targets = [k for k in targets if k[-1] in src_types]
+    relations = {f'{dtype}{stype}': (stype, etype, dtype) for stype, etype, dtype in new_g.canonical_etypes}
+
+    def size_of(k):
+        feat = new_g.nodes[k[-1]].data[k[-1]]
+        return new_g.num_nodes(k[0]) * feat.shape[1] * feat.element_size()
+
+    steps, peak = plan_propagation(targets, size_of, resident=src_types)
+    print(f'Planned {sum(op == "build" for op, _ in steps)} propagations for {len(targets)} metapaths, '
+          f'peak feature memory {peak / 2**30:.2f} GB')
+    if backend == 'csr':
+        feats = {ntype: new_g.nodes[ntype].data.pop(ntype) for ntype in src_types}
+        operators = {}
+    for op, k in steps:
+        if op == 'build':
+            etype = relations[k[:2]]
+            if echo: print(k[1:], etype, k)
+            if backend == 'dgl':
+                new_g[etype].update_all(fn.copy_u(k[1:], 'm'), fn.mean('m', k), etype=etype)
+            else:
+                if k[:2] not in operators:
+                    src, dst = new_g.edges(etype=etype)
+                    operators[k[:2]] = mean_adj(src.numpy(), dst.numpy(), new_g.num_nodes(etype[0]), new_g.num_nodes(etype[2]))
+                feats[k] = operators[k[:2]] @ feats[k[1:]]
+        else:
+            if backend == 'dgl':
+                new_g.nodes[k[0]].data.pop(k)
+            else:
+                feats.pop(k)
+            if echo: print('remove', k)
+    gc.collect()
 
+    if backend == 'dgl':
+        feats = {k: new_g.nodes[tgt_type].data.pop(k) for k in targets}
+    else:
+        feats = {k: feats[k] for k in targets}
+    new_g.nodes[tgt_type].data.update(feats)
     return new_g
 
 
-def hg_propagate_search(new_g, tgt_type, num_hops, max_hops, extra_metapath, echo=False, prop_device='cpu'):
-    for hop in range(1, max_hops):
-        reserve_heads = [ele[:hop] for ele in extra_metapath if len(ele) > hop]
-        for etype in new_g.etypes:
-            stype, _, dtype = new_g.to_canonical_etype(etype)
-
-            for k in list(new_g.nodes[stype].data.keys()):
-                if len(k) == hop:
-                    current_dst_name = f'{dtype}{k}'
-                    if (hop == num_hops and dtype != tgt_type and k not in reserve_heads) \
-                      or (hop > num_hops and k not in reserve_heads):
-                        continue
-                    if echo: print(k, etype, current_dst_name)
-                    new_g[etype].update_all(
-                        fn.copy_u(k, 'm'),
-                        fn.mean('m', current_dst_name), etype=etype)
-
-        # remove no-use items
-        for ntype in new_g.ntypes:
-            if ntype == tgt_type: continue
-            removes = []
-            for k in new_g.nodes[ntype].data.keys():
-                if len(k) <= hop:
-                    removes.append(k)
-            for k in removes:
-                new_g.nodes[ntype].data.pop(k)
-            if echo and len(removes): print('remove', removes)
-        gc.collect()
-
-        if echo: print(f'-- hop={hop} ---')
-        for ntype in new_g.ntypes:
-            for k, v in new_g.nodes[ntype].data.items():
-                if echo: print(f'{ntype} {k} {v.shape}')
-        if echo: print(f'------\n')
-
-    return new_g
+def propagate_targets(new_g, tgt_type, num_hops, max_hops, extra_metapath, meta_path=None):
+    src_types = [ntype for ntype in new_g.ntypes if ntype in new_g.nodes[ntype].data]
+    targets = metapath_keys(new_g, tgt_type, num_hops, src_types) + [ele for ele in extra_metapath if len(ele) <= max_hops]
+    if meta_path is not None:
+        targets = [k for k in targets if k in meta_path or k in extra_metapath or k == tgt_type]
+    return list(dict.fromkeys(targets))
+
+
+def hg_propagate(new_g, tgt_type, num_hops, max_hops, extra_metapath, echo=False, meta_path=None, backend='dgl'):
+    '''
+    If meta_path is given, only the keys it needs are propagated and only meta_path
+    (and the raw tgt_type features) is kept at tgt_type
+    '''
+    targets = propagate_targets(new_g, tgt_type, num_hops, max_hops, extra_metapath, meta_path)
+    return hg_propagate_planned(new_g, tgt_type, targets, echo=echo, backend=backend)
+
+
+@contextmanager
+def intra_op_threads(num_threads):
+    '''
+    torch intra-op threads set to num_threads inside the block and restored on the way out, errors included
+    '''
+    saved = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(saved)
+
+
+def hg_propagate_chunked(new_g, tgt_type, num_hops, max_hops, extra_metapath, num_threads=4, chunk_cols=0,
+                         chunk_bytes=256 * 2**20, echo=False, meta_path=None):
+    '''
+    CPU hg_propagate over column chunks of the features. Mean propagation treats every column on its own,
+    so each chunk runs the whole plan independently on a thread pool (the SpMMs release the GIL) and the
+    outputs are concatenated per metapath. chunk_cols=0 sizes the chunks so the planned peak of the
+    num_threads chunks running at once stays under chunk_bytes. The raw features are moved out of new_g.
+    return a dict of the target features
+    '''
+    src_types = [ntype for ntype in new_g.ntypes if ntype in new_g.nodes[ntype].data]
+    targets = [k for k in propagate_targets(new_g, tgt_type, num_hops, max_hops, extra_metapath, meta_path) if k[-1] in src_types]
+    relations = {f'{dtype}{stype}': (stype, etype, dtype) for stype, etype, dtype in new_g.canonical_etypes}
+
+    # planned peak of a single float32 column
+    steps, peak = plan_propagation(targets, lambda k: new_g.num_nodes(k[0]) * 4, resident=src_types)
+    if chunk_cols <= 0:
+        chunk_cols = max(1, chunk_bytes // (peak * num_threads))
+    raw = {ntype: new_g.nodes[ntype].data.pop(ntype) for ntype in src_types}
+    max_dim = max(v.shape[1] for v in raw.values())
+    chunks = [(beg, min(beg + chunk_cols, max_dim)) for beg in range(0, max_dim, chunk_cols)]
+    print(f'Planned {sum(op == "build" for op, _ in steps)} propagations for {len(targets)} metapaths, '
+          f'{len(chunks)} chunks of {chunk_cols} columns on {num_threads} threads, '
+          f'peak feature memory {peak * chunk_cols * min(num_threads, len(chunks)) / 2**30:.2f} GB')
+
+    adjs = {}
+    for op, k in steps:
+        if op == 'build' and len(k) > 1 and k[:2] not in adjs:
+            stype, etype, dtype = relations[k[:2]]
+            src, dst = new_g.edges(etype=(stype, etype, dtype))
+            adjs[k[:2]] = mean_adj(src.numpy(), dst.numpy(), new_g.num_nodes(stype), new_g.num_nodes(dtype))
+
+    def propagate_chunk(beg, end):
+        feats = {ntype: v[:, beg:end].contiguous() for ntype, v in raw.items() if v.shape[1] > beg}
+        for op, k in steps:
+            if op == 'free':
+                feats.pop(k, None)
+            elif k[1:] in feats:
+                feats[k] = adjs[k[:2]] @ feats[k[1:]]
+        if echo: print(f'columns {beg}:{end} done')
+        return {k: feats[k] for k in targets if k in feats}
+
+    # the chunks already run in parallel, so every SpMM gets a share of the intra-op threads
+    with intra_op_threads(max(1, torch.get_num_threads() // num_threads)):
+        with ThreadPoolExecutor(num_threads) as pool:
+            results = list(pool.map(lambda chunk: propagate_chunk(*chunk), chunks))
+    del raw, adjs
+    gc.collect()
+
+    return {k: torch.cat([r[k] for r in results if k in r], dim=1) for k in targets}
+
+
+def hg_propagate_spill(new_g, tgt_type, num_hops, max_hops, extra_metapath, mem_budget, spill_dir,
+                       half=False, echo=False, meta_path=None, row_index=None):
+    '''
+    hg_propagate under a RAM budget (bytes) for the features and the relation operators: once the operators
+    are counted, half of it holds features in RAM (see SpillStore), the rest bounds the column chunks each SpMM
+    works on, everything else lives in memory-mapped files in spill_dir (float16 if half). The raw features
+    are moved out of new_g. row_index (e.g. init2sort) reorders the rows of the targets inside the store,
+    so spilled targets are never loaded as a whole.
+    return a dict of the target features, memory-mapped ones are backed by already unlinked files
+    '''
+    src_types = [ntype for ntype in new_g.ntypes if ntype in new_g.nodes[ntype].data]
+    targets = [k for k in propagate_targets(new_g, tgt_type, num_hops, max_hops, extra_metapath, meta_path) if k[-1] in src_types]
+    relations = {f'{dtype}{stype}': (stype, etype, dtype) for stype, etype, dtype in new_g.canonical_etypes}
+
+    def size_of(k):
+        return store.nbytes((new_g.num_nodes(k[0]), new_g.nodes[k[-1]].data[k[-1]].shape[1]))
+
+    def adj_bytes(rel):
+        # indptr, int32 indices and float32 values of mean_adj
+        stype, etype, dtype = relations[rel]
+        return (new_g.num_nodes(dtype) + 1) * 8 + new_g.num_edges((stype, etype, dtype)) * 8
+
+    store = SpillStore(spill_dir, 0, np.float16 if half else np.float32)
+    steps, peak = plan_propagation(targets, size_of, resident=src_types)
+    last_use = {k[:2]: i for i, (op, k) in enumerate(steps) if op == 'build'}
+    feat_budget = mem_budget - sum(adj_bytes(rel) for rel in last_use)
+    assert feat_budget > 0, f'the relation operators alone take more than {mem_budget / 2**30:.2f} GB'
+    store.budget = feat_budget // 2
+    work_budget = feat_budget - feat_budget // 2
+
+    def chunk_cols(num_rows):
+        # float32 operand and result chunks plus the conversion copy
+        return max(1, int(work_budget // (3 * 4 * num_rows)))
+
+    print(f'Planned {sum(op == "build" for op, _ in steps)} propagations for {len(targets)} metapaths, '
+          f'peak feature memory {peak / 2**30:.2f} GB, budget {mem_budget / 2**30:.2f} GB '
+          f'({feat_budget / 2**30:.2f} GB without the operators)')
+    for ntype in src_types:
+        feat = new_g.nodes[ntype].data.pop(ntype)
+        if ntype in set(k[-1] for k in targets):
+            store.put(ntype, feat, chunk_cols(feat.shape[0]))
+        del feat
+
+    adjs = {}
+    for i, (op, k) in enumerate(steps):
+        if op == 'free':
+            if k in store.arrays:
+                store.free(k)
+            if echo: print('remove', k)
+            continue
+        if k[:2] not in adjs:
+            stype, etype, dtype = relations[k[:2]]
+            src, dst = new_g.edges(etype=(stype, etype, dtype))
+            adjs[k[:2]] = mean_adj(src.numpy(), dst.numpy(), new_g.num_nodes(stype), new_g.num_nodes(dtype))
+        x = store.get(k[1:])
+        out = store.create(k, (new_g.num_nodes(k[0]), x.shape[1]))
+        spmm_chunked(adjs[k[:2]], x, out, chunk_cols(x.shape[0] + out.shape[0]))
+        if last_use[k[:2]] == i:
+            del adjs[k[:2]]
+        if echo: print(k[1:], relations[k[:2]], k, 'spilled' if store.is_spilled(k) else 'in memory')
+    del adjs
+    gc.collect()
+
+    feats = {}
+    for k in targets:
+        if row_index is not None:
+            # the gathered column chunk and its source
+            store.take_rows(k, row_index, chunk_cols(2 * new_g.num_nodes(k[0])))
+        feats[k] = torch.from_numpy(store.get(k))
+    store.close()
+    return feats
+
+
+def hg_propagate_search(new_g, tgt_type, num_hops, max_hops, extra_metapath, echo=False, prop_device='cpu', backend='dgl'):
+    return hg_propagate(new_g, tgt_type, num_hops, max_hops, extra_metapath, echo=echo, backend=backend)
 # device = "cuda:{}".format(args.gpu) if not args.cpu else 'cpu'
 # g = hg_propagate_split_on_gpu(g, tgt_type, args.num_hops, max_hops, extra_metapath,False,device,32)
 def hg_propagate_split_on_gpu(new_g, tgt_type, num_hops, max_hops, extra_metapath,echo=False,device = 'cpu',split_num = 32, half=False):
     cpu_embedding = {}
     out_embedding = {}
     cpu_split = {}
-    for ntype in new_g.ntypes:
+    feat_types = [ntype for ntype in new_g.ntypes if ntype in new_g.nodes[ntype].data]
+    # every chunk needs at least one column of every type
+    split_num = min([split_num] + [new_g.nodes[ntype].data[ntype].shape[1] for ntype in feat_types])
+    for ntype in feat_types:
         cpu_embedding[ntype] = new_g.nodes[ntype].data.pop(ntype).t()
         if half:
             cpu_embedding[ntype] = cpu_embedding[ntype].half()#.type(torch.float16)
-            
-        if split_num > cpu_embedding[ntype].shape[0]:
-            raise KeyError
+
         split_len =  cpu_embedding[ntype].shape[0]//split_num
         this_split = [[int(split_len*i),int(split_len*(i+1))] for i in range(split_num)]
         this_split[-1][-1] = cpu_embedding[ntype].shape[0]
@@ -177,7 +316,7 @@ def hg_propagate_split_on_gpu(new_g, tgt_type, num_hops, max_hops, extra_metapat
     new_g = new_g.to(device)
 
     for split_index in range(split_num):
-        for ntype in new_g.ntypes:
+        for ntype in feat_types:
             to_split = cpu_split[ntype][split_index]
             new_g.nodes[ntype].data[ntype] = cpu_embedding[ntype][to_split[0]:to_split[1]].t().to(device)
 
@@ -232,7 +371,7 @@ def hg_propagate_split_on_gpu(new_g, tgt_type, num_hops, max_hops, extra_metapat
 
     new_g = new_g.to('cpu')
     for key in list(out_embedding.keys()):
-        new_g.nodes[ntype].data[key] = out_embedding[key]
+        new_g.nodes[tgt_type].data[key] = out_embedding[key]
 
     return new_g
 
@@ -475,7 +614,7 @@ def train(model, train_loader, loss_fcn, optimizer, evaluator, device,
     y_true, y_pred = [], []
 
     for batch in train_loader:
-        batch_feats = {k: x[batch].to(device) for k, x in feats.items()}
+        batch_feats = {k: x[batch].to(device).float() for k, x in feats.items()}
         batch_labels_feats = {k: x[batch].to(device) for k, x in label_feats.items()}
         # if mask is not None:
         #     batch_mask = {k: x[batch].to(device) for k, x in mask.items()}
@@ -526,8 +665,8 @@ def train_search(model, train_loader, loss_fcn, optimizer_w, optimizer_a, val_lo
     ###################  optimize w  ##################
     for batch in train_loader:
         val_batch = next(iter(val_loader)).to(device)
-        batch_feats = {k: x[batch].to(device) for k, x in feats.items()}
-        val_batch_feats = {k: x[val_batch].to(device) for k, x in feats.items()}
+        batch_feats = {k: x[batch].to(device).float() for k, x in feats.items()}
+        val_batch_feats = {k: x[val_batch].to(device).float() for k, x in feats.items()}
         batch_labels_feats = {k: x[batch].to(device) for k, x in label_feats.items()}
         val_batch_labels_feats = {k: x[val_batch].to(device) for k, x in label_feats.items()}
         batch_label_emb = label_emb[batch].to(device)
@@ -606,7 +745,7 @@ def train_multi_stage(model, train_loader, enhance_loader, loss_fcn, optimizer,
         L1_ratio = len(idx_1) * 1.0 / (len(idx_1) + len(idx_2))
         L2_ratio = len(idx_2) * 1.0 / (len(idx_1) + len(idx_2))
 
-        batch_feats = {k: x[idx].to(device) for k, x in feats.items()}
+        batch_feats = {k: x[idx].to(device).float() for k, x in feats.items()}
         batch_labels_feats = {k: x[idx].to(device) for k, x in label_feats.items()}
         batch_label_emb = label_emb[idx].to(device)
         y = labels[idx_1].to(torch.long).to(device)
@@ -665,8 +804,8 @@ def train_search(model, train_loader, loss_fcn, optimizer_w, optimizer_a, val_lo
     ###################  optimize w  ##################
     for batch in train_loader:
         val_batch = next(iter(val_loader)).to(device)
-        batch_feats = {k: x[batch].to(device) for k, x in feats.items()}
-        val_batch_feats = {k: x[val_batch].to(device) for k, x in feats.items()}
+        batch_feats = {k: x[batch].to(device).float() for k, x in feats.items()}
+        val_batch_feats = {k: x[val_batch].to(device).float() for k, x in feats.items()}
         batch_labels_feats = {k: x[batch].to(device) for k, x in label_feats.items()}
         val_batch_labels_feats = {k: x[val_batch].to(device) for k, x in label_feats.items()}
         batch_label_emb = label_emb[batch].to(device)
@@ -737,7 +876,7 @@ def gen_output_torch(model, feats, label_feats, label_emb, test_loader, device):
     model.eval()
     preds = []
     for batch in tqdm(test_loader):
-        batch_feats = {k: x[batch].to(device) for k, x in feats.items()}
+        batch_feats = {k: x[batch].to(device).float() for k, x in feats.items()}
         batch_labels_feats = {k: x[batch].to(device) for k, x in label_feats.items()}
         batch_label_emb = label_emb[batch].to(device)
         preds.append(model(batch_feats, batch_labels_feats,batch_label_emb).cpu())
@@ -749,7 +888,7 @@ def gen_output_torch_search(model, feats, label_feats, label_emb, test_loader, d
     model.eval()
     preds = []
     for batch in tqdm(test_loader):
-        batch_feats = {k: x[batch].to(device) for k, x in feats.items()}
+        batch_feats = {k: x[batch].to(device).float() for k, x in feats.items()}
         batch_labels_feats = {k: x[batch].to(device) for k, x in label_feats.items()}
         batch_label_emb = label_emb[batch].to(device)
         preds.append(model(batch_feats, idx, batch_labels_feats, batch_label_emb).cpu())
@@ -765,102 +904,318 @@ def get_ogb_evaluator(dataset):
         })["acc"]
 
 
-def load_dataset(args):
+def load_dataset(args, feat_paths=None, label_paths=None):
     if args.dataset == 'ogbn-mag':
         # train/val/test 629571/64879/41939
-        return load_mag(args)
+        return load_mag(args, feat_paths=feat_paths, label_paths=label_paths)
     else:
         assert 0, 'Only allowed [ogbn-mag]'
 
 
-def degree_limit(edge_node,max_degree):
-    from collections import Counter
-    edge_node_list = edge_node.cpu().tolist()
-    node_Counter = Counter(edge_node_list)
-    out_Counter = {}
-    for key in node_Counter.keys():
-        if node_Counter[key] > max_degree:
-            out_Counter[key] = max_degree
-
+# F --- *P --- A --- I
+MAG_NODE_TYPES = {'paper': 'P', 'author': 'A', 'institution': 'I', 'field_of_study': 'F'}
+
+
+def get_schema(args, feat_paths=None, label_paths=None):
+    '''
+    Relations (keys like 'PA', dst then src) and node types whose features are needed, None to load everything.
+    They come from the given metapaths (e.g. an arch of arch.py), otherwise from the type alphabet --schema_types
+    '''
+    if feat_paths is not None:
+        relations, feat_types = set(), {'P'}
+        for path in list(feat_paths) + list(label_paths or []):
+            relations.update(path[i:i+2] for i in range(len(path) - 1))
+        feat_types.update(path[-1] for path in feat_paths)
+        return relations, feat_types
+    if len(args.schema_types):
+        return {a + b for a in args.schema_types for b in args.schema_types}, set(args.schema_types)
+    return None
+
+
+def degree_limit(edge_node, max_degree, generator=None):
+    '''
+    Keep at most max_degree edges for each node in edge_node, return a bool mask over edges.
+    The first max_degree edges (in edge order) are kept, or a random subset of them if a generator is given
+    '''
+    num_edges = edge_node.size(0)
+    if generator is None:
+        order = torch.arange(num_edges, device=edge_node.device)
+    else:
+        order = torch.randperm(num_edges, generator=generator).to(edge_node.device)
+    # a stable sort by node keeps the (shuffled) edge order within each node
+    _, perm = torch.sort(edge_node[order], stable=True)
+    perm = order[perm]
 
-    out_mask = torch.zeros(edge_node.shape) != 0.0
-    for index,key in enumerate(edge_node_list):
-        if key not in out_Counter:
-            out_mask[index] = True
-        else:
-            if out_Counter[key] >= 1:
-                out_mask[index] = True
-                out_Counter[key] -= 1
+    _, counts = torch.unique_consecutive(edge_node[perm], return_counts=True)
+    start = torch.cumsum(counts, dim=0) - counts
+    rank = torch.arange(num_edges, device=edge_node.device) - torch.repeat_interleave(start, counts)
 
+    out_mask = torch.zeros(num_edges, dtype=torch.bool, device=edge_node.device)
+    out_mask[perm[rank < max_degree]] = True
     return out_mask
 
 
-def load_mag(args, symmetric=True):
+def parse_rel_max_deg(items):
+    '''
+    Parse per-relation degree caps given as etype=k, e.g. ['cites=10', 'writes=5']
+    '''
+    rel_max_deg = {}
+    for item in items:
+        etype, k = item.split('=')
+        rel_max_deg[etype] = int(k)
+    return rel_max_deg
+
+
+def write_mag_snapshot(path, num_nodes, canonical_etypes, edges, paper_feat, labels, splits):
+    '''
+    Write a local binary snapshot of ogbn-mag into the directory path.
+    Every relation is kept as a CSR over its dst nodes (int32 indices) together with the edge ids
+    of the CSR entries, so the original edge order can be restored. meta.json is written last
+    and marks a complete snapshot
+    '''
+    os.makedirs(path, exist_ok=True)
+    for stype, etype, dtype in canonical_etypes:
+        src, dst = [np.asarray(x, dtype=np.int64) for x in edges[etype]]
+        order = np.lexsort((src, dst))
+        indptr = np.zeros(num_nodes[dtype] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(dst, minlength=num_nodes[dtype]), out=indptr[1:])
+        np.save(os.path.join(path, f'{etype}_indptr.npy'), indptr)
+        np.save(os.path.join(path, f'{etype}_indices.npy'), src[order].astype(np.int32))
+        np.save(os.path.join(path, f'{etype}_eid.npy'), order.astype(np.int32))
+    np.save(os.path.join(path, 'paper_feat.npy'), np.ascontiguousarray(paper_feat, dtype=np.float32))
+    np.save(os.path.join(path, 'labels.npy'), np.asarray(labels, dtype=np.int64))
+    for name, nid in splits.items():
+        np.save(os.path.join(path, f'{name}_nid.npy'), np.asarray(nid, dtype=np.int64))
+
+    meta = {'num_nodes': num_nodes, 'canonical_etypes': [list(x) for x in canonical_etypes]}
+    with open(os.path.join(path, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(path, 'meta.json.tmp'), os.path.join(path, 'meta.json'))
+
+
+def save_mag_snapshot(args, path):
+    '''
+    One-time conversion of the DGL ogbn-mag dataset into a local snapshot
+    '''
     dataset = DglNodePropPredDataset(name=args.dataset, root=args.root)
     splitted_idx = dataset.get_idx_split()
-
     g, init_labels = dataset[0]
-    splitted_idx = dataset.get_idx_split()
-    train_nid = splitted_idx['train']['paper']
-    val_nid = splitted_idx['valid']['paper']
-    test_nid = splitted_idx['test']['paper']
 
-    features = g.nodes['paper'].data['feat']
+    edges = {}
+    for i, etype in enumerate(g.etypes):
+        src, dst, eid = g._graph.edges(i)
+        assert torch.all(eid == torch.arange(len(eid))), 'edges are expected in edge id order'
+        edges[etype] = (src.numpy(), dst.numpy())
+    num_nodes = {ntype: g.num_nodes(ntype) for ntype in g.ntypes}
+    splits = {name: splitted_idx[name]['paper'].numpy() for name in ['train', 'valid', 'test']}
+    write_mag_snapshot(path, num_nodes, g.canonical_etypes, edges,
+                       g.nodes['paper'].data['feat'].numpy(), init_labels['paper'].squeeze().numpy(), splits)
+
+
+def load_mag_snapshot(path):
+    '''
+    Load a snapshot written by write_mag_snapshot, paper features are memory-mapped (copy-on-write).
+    return a dict with num_nodes, canonical_etypes, csr (etype -> (indptr, indices, eid) numpy arrays),
+    paper_feat, labels and the train/valid/test node ids
+    '''
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    snapshot = {'num_nodes': meta['num_nodes'], 'canonical_etypes': [tuple(x) for x in meta['canonical_etypes']], 'csr': {}}
+    for stype, etype, dtype in snapshot['canonical_etypes']:
+        snapshot['csr'][etype] = tuple(np.load(os.path.join(path, f'{etype}_{name}.npy')) for name in ['indptr', 'indices', 'eid'])
+    snapshot['paper_feat'] = torch.from_numpy(np.load(os.path.join(path, 'paper_feat.npy'), mmap_mode='c'))
+    snapshot['labels'] = torch.from_numpy(np.load(os.path.join(path, 'labels.npy')))
+    for name in ['train', 'valid', 'test']:
+        snapshot[f'{name}_nid'] = torch.from_numpy(np.load(os.path.join(path, f'{name}_nid.npy')))
+    return snapshot
+
+
+def snapshot_edges(csr):
+    '''
+    (src, dst) LongTensors of a snapshot relation in the original edge id order
+    '''
+    indptr, indices, eid = csr
+    src = np.empty(len(eid), dtype=np.int64)
+    dst = np.empty(len(eid), dtype=np.int64)
+    src[eid] = indices
+    dst[eid] = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+    return torch.from_numpy(src), torch.from_numpy(dst)
+
+
+def snapshot_adj(csr):
+    '''
+    SparseTensor [dst, src] of a snapshot relation built straight from its CSR,
+    sizes are inferred from the largest node ids like SparseTensor(row=dst, col=src)
+    '''
+    indptr, indices, _ = csr
+    num_rows = np.flatnonzero(np.diff(indptr))[-1] + 1 if len(indices) else 0
+    num_cols = int(indices.max()) + 1 if len(indices) else 0
+    return SparseTensor(rowptr=torch.from_numpy(indptr[:num_rows+1]), col=torch.from_numpy(indices.astype(np.int64)),
+                        sparse_sizes=(num_rows, num_cols), is_sorted=True)
+
+
+def get_snapshot_dir(args):
+    return args.snapshot_dir or os.path.join(args.root, f'{args.dataset}_snapshot')
+
+
+def metapath_keys(g, tgt_type, num_hops, src_types):
+    '''
+    Keys hg_propagate produces at tgt_type (without extra_metapath), in the order the hop-by-hop
+    propagation creates them: every metapath of at most num_hops relations of g that starts from one of src_types
+    '''
+    keys = {ntype: [ntype] if ntype in src_types else [] for ntype in g.ntypes}
+    for hop in range(1, num_hops + 1):
+        for stype, _, dtype in g.canonical_etypes:
+            for k in list(keys[stype]):
+                if len(k) == hop and (hop < num_hops or dtype == tgt_type):
+                    keys[dtype].append(f'{dtype}{k}')
+        for ntype in g.ntypes:
+            if ntype != tgt_type:
+                keys[ntype] = [k for k in keys[ntype] if len(k) > hop]
+    return list(dict.fromkeys(keys[tgt_type]))
+
+
+def prop_cache_dir(args, feat_types):
+    '''
+    Propagated-feature cache for one snapshot, degree limit and embedding setting, with a file per metapath.
+    A metapath's features do not depend on num_hops, so a run with fewer hops (or a subset of
+    metapaths) is served by the files of a larger run. Random embeddings are drawn after
+    set_random_seed and only for the loaded types, so without extra embeddings both are part of the key.
+    Without a seed they differ from run to run, then the dir is None and nothing is cached
+    '''
+    with open(os.path.join(get_snapshot_dir(args), 'meta.json'), 'rb') as f:
+        snapshot_digest = hashlib.sha1(f.read()).hexdigest()
+    if len(args.extra_embedding):
+        embedding = f'embedding={args.extra_embedding}:{os.path.abspath(args.emb_path)}'
+    elif args.seed > 0:
+        embedding = f'embedding=random{args.embed_size}:seed={args.seed}:types={"".join(sorted(feat_types))}'
+    else:
+        print('Random embeddings without a seed, propagated features are not cached')
+        return None, None
+    key = ';'.join([snapshot_digest, args.dataset, f'edge_mask_ratio={args.edge_mask_ratio}',
+                    f'out_max_deg={args.out_max_deg}', f'in_max_deg={args.in_max_deg}',
+                    f'rel_out_max_deg={sorted(args.rel_out_max_deg)}', f'rel_in_max_deg={sorted(args.rel_in_max_deg)}',
+                    f'random_deg_limit={args.random_deg_limit}:{args.mask_seed}', embedding,
+                    f'emb_half={getattr(args, "split_on_gpu", False) and getattr(args, "emb_half", False)}',
+                    f'spill_half={spill_propagation(args) and args.spill_half}', f'sorted_rows={spill_propagation(args)}'])
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(args.prop_cache_dir or get_snapshot_dir(args), f'prop_cache_{digest}'), key
+
+
+def spill_propagation(args):
+    '''
+    Whether the scripts propagate with hg_propagate_spill, whose features (cached ones too) already have sorted rows
+    '''
+    return args.prop_mem_budget > 0 and not getattr(args, 'split_on_gpu', False)
+
+
+def load_prop_cache(cache_dir, key, keys, mmap=False):
+    '''
+    Cached features of keys, in the order they were first propagated. None if any of them is missing.
+    mmap maps the files instead of reading them
+    '''
+    try:
+        with open(os.path.join(cache_dir, 'index.json')) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index['key'] != key or not all(k in index['keys'] for k in keys):
+        return None
+    return {k: torch.load(os.path.join(cache_dir, f'{k}.pt'), mmap=mmap) for k in sorted(keys, key=index['keys'].index)}
+
+
+def save_prop_cache(cache_dir, key, feats):
+    '''
+    Add the features not cached yet, the index is rewritten after their files
+    '''
+    index = {'key': key, 'keys': []}
+    if os.path.exists(os.path.join(cache_dir, 'index.json')):
+        with open(os.path.join(cache_dir, 'index.json')) as f:
+            index = json.load(f)
+        if index['key'] != key:
+            index = {'key': key, 'keys': []}
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for k, v in feats.items():
+            if k in index['keys']:
+                continue
+            torch.save(v, os.path.join(cache_dir, f'{k}.pt'))
+            index['keys'].append(k)
+        with open(os.path.join(cache_dir, 'index.json.tmp'), 'w') as f:
+            json.dump(index, f)
+        os.replace(os.path.join(cache_dir, 'index.json.tmp'), os.path.join(cache_dir, 'index.json'))
+        print(f'Save propagated features to {cache_dir}')
+    except OSError as e:
+        print(f'Warning: cannot write propagated feature cache {cache_dir}: {e}')
+
+
+def load_mag(args, symmetric=True, feat_paths=None, label_paths=None):
+    '''
+    feat_paths/label_paths: only build the relations and load the embeddings these metapaths reach
+    '''
+    schema = get_schema(args, feat_paths, label_paths)
+    snapshot_dir = get_snapshot_dir(args)
+    if not os.path.exists(os.path.join(snapshot_dir, 'meta.json')):
+        print(f'Build local snapshot of {args.dataset} in {snapshot_dir}')
+        save_mag_snapshot(args, snapshot_dir)
+    snapshot = load_mag_snapshot(snapshot_dir)
+    num_nodes = snapshot['num_nodes']
+    train_nid = snapshot['train_nid']
+    val_nid = snapshot['valid_nid']
+    test_nid = snapshot['test_nid']
+
+    # embeddings are only loaded (or drawn) for node types the schema needs
+    feats = {'paper': snapshot['paper_feat']}
     if len(args.extra_embedding):
         print(f'Use extra embeddings generated with the {args.extra_embedding} method')
         # path = os.path.join(args.emb_path, f'{args.extra_embedding}_nars')
         path = args.emb_path
+    for name in ['author', 'field_of_study', 'institution']:
+        if schema is not None and MAG_NODE_TYPES[name] not in schema[1]:
+            continue
+        if len(args.extra_embedding):
+            feats[name] = torch.load(os.path.join(path, f'{name}.pt'), map_location=torch.device('cpu')).float()
+        else:
+            feats[name] = torch.Tensor(num_nodes[name], args.embed_size).uniform_(-0.5, 0.5)
 
-        author_emb = torch.load(os.path.join(path, 'author.pt'), map_location=torch.device('cpu')).float()
-        topic_emb = torch.load(os.path.join(path, 'field_of_study.pt'), map_location=torch.device('cpu')).float()
-        institution_emb = torch.load(os.path.join(path, 'institution.pt'), map_location=torch.device('cpu')).float()
-    else:
-        author_emb = torch.Tensor(g.num_nodes('author'), args.embed_size).uniform_(-0.5, 0.5)
-        topic_emb = torch.Tensor(g.num_nodes('field_of_study'), args.embed_size).uniform_(-0.5, 0.5)
-        institution_emb = torch.Tensor(g.num_nodes('institution'), args.embed_size).uniform_(-0.5, 0.5)
-
-    g.nodes['paper'].data['feat'] = features
-    g.nodes['author'].data['feat'] = author_emb
-    g.nodes['institution'].data['feat'] = institution_emb
-    g.nodes['field_of_study'].data['feat'] = topic_emb
-
-    init_labels = init_labels['paper'].squeeze()
+    init_labels = snapshot['labels']
     n_classes = int(init_labels.max()) + 1
     evaluator = get_ogb_evaluator(args.dataset)
 
-    # for k in g.ntypes:
-    #     print(k, g.ndata['feat'][k].shape)
-    for k in g.ntypes:
-        print(k, g.nodes[k].data['feat'].shape)
+    for k, v in feats.items():
+        print(k, v.shape)
 
     edge_mask_ratio = args.edge_mask_ratio
 
     adjs = []
 
-    # generator = torch.Generator().manual_seed(args.mask_seed)
+    generator = torch.Generator().manual_seed(args.mask_seed) if args.random_deg_limit else None
     out_max_degree = args.out_max_deg # 5
     in_max_degree = args.in_max_deg # 0
+    rel_out_max_degree = parse_rel_max_deg(args.rel_out_max_deg)
+    rel_in_max_degree = parse_rel_max_deg(args.rel_in_max_deg)
 
     num_edgs = 0
 
-    for i, etype in enumerate(g.etypes):
-        src, dst, eid = g._graph.edges(i)
+    for canonical_etype in snapshot['canonical_etypes']:
+        etype = canonical_etype[1]
         edge_keep = None
 
-        if out_max_degree is not None and out_max_degree > 0:
-            edge_keep = degree_limit(src,out_max_degree)
-        elif in_max_degree is not None and in_max_degree > 0:
-            edge_keep = degree_limit(dst,in_max_degree)
-
-
-        if edge_keep != None:
-            src = src[edge_keep]
-            dst = dst[edge_keep]
-            eid = eid[edge_keep]
-
-        adj = SparseTensor(row=dst, col=src)
+        # per-relation caps override the global ones, out-degree caps take precedence
+        out_cap = rel_out_max_degree.get(etype, out_max_degree)
+        in_cap = rel_in_max_degree.get(etype, in_max_degree)
+        if out_cap is not None and out_cap > 0 or in_cap is not None and in_cap > 0:
+            # degree caps keep edges by their original order
+            src, dst = snapshot_edges(snapshot['csr'][etype])
+            if out_cap is not None and out_cap > 0:
+                edge_keep = degree_limit(src, out_cap, generator)
+            else:
+                edge_keep = degree_limit(dst, in_cap, generator)
+            adj = SparseTensor(row=dst[edge_keep], col=src[edge_keep])
+        else:
+            adj = snapshot_adj(snapshot['csr'][etype])
         adjs.append(adj)
-        print(g.to_canonical_etype(etype), adj)
+        print(canonical_etype, adj)
     
     # print("num_edgs:", num_edgs)
     # exit()
@@ -888,24 +1243,26 @@ def load_mag(args, symmetric=True):
     for etype, adj in zip(etypes, adjs):
         stype, rtype, dtype = etype
         dst, src, _ = adj.coo()
-        src = src.numpy()
-        dst = dst.numpy()
+        src = src.numpy().astype(np.int32)
+        dst = dst.numpy().astype(np.int32)
         if stype == dtype:
-            new_edges[(stype, rtype, dtype)] = (np.concatenate((src, dst)), np.concatenate((dst, src)))
+            if schema is None or f'{dtype}{stype}' in schema[0]:
+                new_edges[(stype, rtype, dtype)] = (np.concatenate((src, dst)), np.concatenate((dst, src)))
         else:
-            new_edges[(stype, rtype, dtype)] = (src, dst)
-            new_edges[(dtype, rtype[::-1], stype)] = (dst, src)
+            if schema is None or f'{dtype}{stype}' in schema[0]:
+                new_edges[(stype, rtype, dtype)] = (src, dst)
+            if schema is None or f'{stype}{dtype}' in schema[0]:
+                new_edges[(dtype, rtype[::-1], stype)] = (dst, src)
         ntypes.add(stype)
         ntypes.add(dtype)
-    num_nodes_dict = {'P':g.nodes['paper'].data['feat'].shape[0],
-                     'A':g.nodes['author'].data['feat'].shape[0],
-                     'I':g.nodes['institution'].data['feat'].shape[0],
-                     'F':g.nodes['field_of_study'].data['feat'].shape[0]}
-    new_g = dgl.heterograph(new_edges,num_nodes_dict = num_nodes_dict)
-    new_g.nodes['P'].data['P'] = g.nodes['paper'].data['feat']
-    new_g.nodes['A'].data['A'] = g.nodes['author'].data['feat']
-    new_g.nodes['I'].data['I'] = g.nodes['institution'].data['feat']
-    new_g.nodes['F'].data['F'] = g.nodes['field_of_study'].data['feat']
+    if schema is not None:
+        print(f'Pruned schema: relations {sorted(f"{k[2]}{k[0]}" for k in new_edges)}, feature types {sorted(schema[1])}')
+    num_nodes_dict = {ntype: num_nodes[name] for name, ntype in MAG_NODE_TYPES.items()}
+    new_g = dgl.heterograph(new_edges, num_nodes_dict=num_nodes_dict, idtype=torch.int32)
+    for name, feat in feats.items():
+        ntype = MAG_NODE_TYPES[name]
+        if ntype in new_g.ntypes:
+            new_g.nodes[ntype].data[ntype] = feat
 
     IA, PA, PP, FP = adjs
 